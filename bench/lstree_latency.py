@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+""" Checks that the live search engines are fast enough to search on every
+    keystroke: builds them on a random library and fails if the worst
+    time of a query, typed character by character with a typo, exceeds
+    the bound.  Every word is typed on a freshly built tree, and every
+    keystroke is timed once, with the collector disabled. """
+
+import gc
+import os
+import sys
+import time
+import random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from lstree import SimpleCachingLSTree, NGramLSTree, FuzzyLSTree, \
+                   FUZZY_LENGTHS
+
+DEFAULT_SIZE = 200000
+DEFAULT_WORDS = 10
+# Maximum seconds a keystroke may take, per engine
+MAX_KEYSTROKE = {SimpleCachingLSTree: 0.2,
+                 NGramLSTree: 0.2,
+                 FuzzyLSTree: 0.25}
+# Maximum seconds the FuzzyLSTree may add to its exact LSTree
+MAX_FUZZY_OVERHEAD = 0.1
+
+def _cmp(x, y):
+        return cmp(x, y)
+
+def make_library(n, r):
+        """ Returns <n> random entries (text, obj) of Zipf distributed
+            words """
+        letters = 'etaoinshrdlcumwfgypbvkjxqz'
+        vocab = [''.join([r.choice(letters[:r.randint(8, 26)])
+                                for j in xrange(r.randint(2, 10))])
+                        for i in xrange(n // 4)]
+        return [(' '.join([vocab[int(len(vocab) ** r.random()) - 1]
+                                for j in xrange(r.randint(2, 6))]), i)
+                        for i in xrange(n)]
+
+def make_queries(entries, n, r):
+        """ Returns the sequences of queries of typing <n> words of the
+            <entries> character by character, with a typo in the longer
+            ones """
+        letters = 'etaoinshrdlcumwfgypbvkjxqz'
+        ret = list()
+        for i in xrange(n):
+                w = r.choice(r.choice(entries)[0].split())
+                if len(w) >= FUZZY_LENGTHS[0]:
+                        j = r.randrange(len(w))
+                        w = w[:j] + r.choice(letters) + w[j+1:]
+                ret.append([w[:j] for j in xrange(1, len(w) + 1)])
+        return ret
+
+def _time(tree, q):
+        start = time.time()
+        for obj in tree.query(q):
+                pass
+        return time.time() - start
+
+def measure(cls, entries, sequences):
+        """ Returns the time of each query of the <sequences> on a new
+            LSTree <cls> of <entries> for each sequence, and the time it
+            took to build the trees.  For a FuzzyLSTree, it returns too
+            the time of each query on its exact tree. """
+        times = list()
+        exact_times = list()
+        build_time = 0
+        for queries in sequences:
+                start = time.time()
+                tree = cls(entries, _cmp=_cmp)
+                build_time += time.time() - start
+                gc.collect()
+                # The first allocation of a few KB after the build makes
+                # malloc merge the many small blocks the build freed,
+                # which would be charged to whichever keystroke is first.
+                [None] * 1024
+                gc.disable()
+                try:
+                        for q in queries:
+                                times.append(_time(tree, q))
+                                if cls is FuzzyLSTree:
+                                        exact_times.append(
+                                                _time(tree.exact, q))
+                finally:
+                        gc.enable()
+                del tree
+        return times, exact_times, build_time
+
+def main():
+        parser = OptionParser(usage="usage: %prog [options]")
+        parser.add_option("-n", "--size", dest="size", type=int,
+                        default=DEFAULT_SIZE, metavar="N",
+                        help="Search a library of N entries")
+        parser.add_option("-s", "--seed", dest="seed", type=int, default=0,
+                        help="Seed of the random library")
+        parser.add_option("-w", "--words", dest="words", type=int,
+                        default=DEFAULT_WORDS, metavar="N",
+                        help="Type N words, each on a new tree")
+        (options, args) = parser.parse_args()
+
+        r = random.Random(options.seed)
+        entries = make_library(options.size, r)
+        sequences = make_queries(entries, options.words, r)
+        failed = False
+        for cls in (SimpleCachingLSTree, NGramLSTree, FuzzyLSTree):
+                times, exact_times, build_time = measure(cls, entries,
+                                                         sequences)
+                print "%s: built in %.2fs" % (cls.__name__,
+                                build_time / len(sequences))
+                worst = max(times)
+                ok = worst <= MAX_KEYSTROKE[cls]
+                failed |= not ok
+                print "  worst keystroke: %.1fms (max %.1fms) %s" % (
+                                worst * 1000, MAX_KEYSTROKE[cls] * 1000,
+                                "ok" if ok else "FAILED")
+                if cls is FuzzyLSTree:
+                        extra = max([t - e for t, e in zip(times,
+                                                           exact_times)])
+                        ok = extra <= MAX_FUZZY_OVERHEAD
+                        failed |= not ok
+                        print "  worst fuzzy overhead: %.1fms (max %.1fms)" \
+                              " %s" % (extra * 1000,
+                                        MAX_FUZZY_OVERHEAD * 1000,
+                                        "ok" if ok else "FAILED")
+        if failed:
+                sys.exit(1)
+
+if __name__ == '__main__':
+        main()
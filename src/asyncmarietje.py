@@ -0,0 +1,217 @@
+import sys
+import socket
+import asyncore
+import asynchat
+from marietje import DEFAULT_HOST, DEFAULT_PORT, MarietjeException, \
+                     ConnectionLostException, parse_queue_header, \
+                     parse_queue_song, parse_playing, parse_list_header, \
+                     parse_track, parse_request_reply, \
+                     upload_request
+
+UPLOAD_CHUNK_SIZE = 65536
+
+class _Request(asynchat.async_chat):
+        """ A single request to marietjed on its own connection.  The reply
+            is fed line by line to the generator <reader>, which should
+            return when the reply is complete.  Exceptions raised while
+            handling the reply are passed to <errCb>. """
+
+        def __init__(self, raw, msg, reader, errCb):
+                asynchat.async_chat.__init__(self, map=raw.map)
+                self.reader = reader
+                self.errCb = errCb
+                self.buf = list()
+                self.done = False
+                self.set_terminator('\n')
+                self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.connect((raw.host, raw.port))
+                self.push(msg)
+                # Run the reader up to where it waits for the first line
+                self._feed(None)
+
+        def collect_incoming_data(self, data):
+                self.buf.append(data)
+
+        def found_terminator(self):
+                l = ''.join(self.buf)
+                self.buf = list()
+                self._feed(l)
+
+        def _feed(self, l):
+                if self.done:
+                        return
+                try:
+                        self.reader.send(l)
+                except StopIteration:
+                        self.done = True
+                        self.close()
+                except Exception, e:
+                        self._fail(e)
+
+        def _fail(self, e):
+                self.done = True
+                self.close()
+                if not self.errCb is None:
+                        self.errCb(e)
+
+        def handle_close(self):
+                if self.get_terminator() is None:
+                        # The reply is delimited by the daemon closing
+                        # the connection.
+                        self.found_terminator()
+                if not self.done:
+                        self._fail(ConnectionLostException(
+                                        "Connection lost: %s" %
+                                                ''.join(self.buf)))
+                self.close()
+
+        def handle_error(self):
+                e = sys.exc_info()[1]
+                if not isinstance(e, MarietjeException):
+                        e = MarietjeException(str(e))
+                self._fail(e)
+
+class _FileProducer:
+        """ Produces <size> bytes from the file <f> """
+        def __init__(self, f, size, progressCb=None):
+                self.f = f
+                self.left = size
+                self.size = size
+                self.progressCb = progressCb
+
+        def more(self):
+                if self.left == 0:
+                        return ''
+                data = self.f.read(min(UPLOAD_CHUNK_SIZE, self.left))
+                if len(data) == 0:
+                        raise MarietjeException, "File is shorter than size"
+                self.left -= len(data)
+                if not self.progressCb is None:
+                        self.progressCb(self.size - self.left, self.size)
+                return data
+
+class AsyncRawMarietje:
+        """ Asynchronous almost direct interface to the Marietje protocol.
+            Every request uses its own connection in the asyncore socket
+            map <map>, such that a single asyncore.loop can drive many
+            concurrent requests.  Results are passed to callbacks;
+            exceptions to <errCb>. """
+
+        def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, map=None):
+                self.host = host
+                self.port = port
+                self.map = dict() if map is None else map
+
+        def _request(self, msg, reader, errCb):
+                return _Request(self, msg, reader, errCb)
+
+        def check_login(self, username, cb, errCb=None):
+                """ Calls <cb> with whether <username> is allowed on
+                    marietje """
+                def reader():
+                        cb((yield) == "LOGIN::SUCCESS")
+                self._request("LOGIN::USER::%s\n" % username, reader(), errCb)
+
+        def get_queue(self, cb, errCb=None):
+                """ Calls <cb> with ( timeLeft, queue ) where queue is a
+                    list of ( artist, title, length, requestedBy ) tuples. """
+                def reader():
+                        total, timeLeft = parse_queue_header((yield))
+                        rl = list()
+                        for i in xrange(total):
+                                rl.append(parse_queue_song((yield)))
+                        cb((timeLeft, rl))
+                self._request("LIST::QUEUE\n", reader(), errCb)
+
+        def get_playing(self, cb, errCb=None):
+                """ Calls <cb> with (id, timeStamp, length, time), see
+                    RawMarietje.get_playing """
+                def reader():
+                        cb(parse_playing((yield)))
+                self._request("LIST::NOWPLAYING\n", reader(), errCb)
+
+        def list_tracks(self, trackCb, doneCb=None, errCb=None,
+                        totalCb=None):
+                """ Calls <trackCb> for every (trackId, artist, title, flag)
+                    and <doneCb> after the last.  <totalCb> is called with
+                    the number of tracks before the first. """
+                def reader():
+                        total = parse_list_header((yield))
+                        if not totalCb is None:
+                                totalCb(total)
+                        for i in xrange(total):
+                                trackCb(parse_track((yield)))
+                        if not doneCb is None:
+                                doneCb()
+                self._request('LIST::ALL', reader(), errCb)
+
+        def request_track(self, trackId, user, cb=None, errCb=None):
+                """ Requests the song <trackId> under the username <user> and
+                    calls <cb> when done """
+                def reader():
+                        parse_request_reply((yield))
+                        if not cb is None:
+                                cb()
+                r = self._request("REQUEST::SONG::%s::USER::%s" % (
+                                trackId, user), reader(), errCb)
+                r.set_terminator(None)
+
+        def upload_track(self, artist, title, user, size, f, cb=None,
+                         errCb=None, progressCb=None):
+                """ Uploads <size> bytes of <f> as the track
+                    <artist> - <title> as <user> and calls <cb> when done.
+                    <progressCb> is called with the number of bytes sent
+                    and <size>. """
+                def reader():
+                        l = (yield)
+                        if l != 'SEND::FILE':
+                                raise MarietjeException, \
+                                        "Unexpected reply: %s" % l
+                        r.set_terminator(None)
+                        r.push_with_producer(_FileProducer(f, size,
+                                        progressCb))
+                        l = (yield)
+                        if l != 'UPLOAD::SUCCESS':
+                                raise MarietjeException, \
+                                        "Unexpected reply: %s" % l
+                        if not cb is None:
+                                cb()
+                r = self._request(upload_request(artist, title, user, size),
+                                  reader(), errCb)
+                # SEND::FILE is not followed by a newline
+                r.set_terminator(len('SEND::FILE'))
+
+class AsyncMarietje:
+        """ Asynchronous counterpart of Marietje, to be driven by
+            asyncore: either by <loop> or by the caller's own loop over
+            <map>. """
+
+        def __init__(self, username, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                        map=None):
+                self.raw = AsyncRawMarietje(host, port, map)
+                self.map = self.raw.map
+                self.username = username
+
+        def loop(self, timeout=30.0, count=None):
+                """ Handles the requests until all are done """
+                asyncore.loop(timeout=timeout, map=self.map, count=count)
+
+        def get_queue(self, cb, errCb=None):
+                self.raw.get_queue(cb, errCb)
+
+        def get_playing(self, cb, errCb=None):
+                self.raw.get_playing(cb, errCb)
+
+        def list_tracks(self, trackCb, doneCb=None, errCb=None):
+                self.raw.list_tracks(trackCb, doneCb, errCb)
+
+        def request_track(self, track_id, cb=None, errCb=None):
+                """ Requests the track with id <track_id> """
+                self.raw.request_track(track_id, self.username, cb, errCb)
+
+        def upload_track(self, artist, title, size, f, cb=None, errCb=None,
+                         progressCb=None):
+                """ Uploads a track in <f> with <size> to marietje as
+                    <artist> - <title> """
+                self.raw.upload_track(artist, title, self.username, size, f,
+                                      cb, errCb, progressCb)
@@ -12,18 +12,32 @@ import optparse
 import threading
 import subprocess
 from random import random
-from marietje import Marietje, MarietjeException
+from marietje import Marietje, MarietjeException, ResultView, ColumnStats, \
+                     DEFAULT_LS_ENGINE
 from cStringIO import StringIO
 
 VERSION = 9
 INITIAL_TIMEOUT = 100
 DEFAULT_TIMEOUT = 1000
+# Timeout of the main loop while a search is running
+SEARCH_TIMEOUT = 20
+# Number of results pulled in at a time after the first are shown
+SEARCH_FILL_CHUNK = 4096
+# Number of results of which the cells are measured to lay out the columns
+STATS_SAMPLE = 1000
+# Milliseconds to wait past the second at which a countdown changes
+TICK_MARGIN = 5
+# Number of formatted times to remember
+TIME_CACHE_SIZE = 4096
 
 (CP_WHITE, CP_BLUE, CP_GREEN, CP_RED,
  CP_CWHITE, CP_CBLUE, CP_CGREEN, CP_CRED) = range(8)
 
 GOT_COLORS = True
 
+# Contents of a line in the shadow buffer that has to be drawn
+UNKNOWN_LINE = object()
+
 def curses_use_default_colors(*args, **kwargs):
         if not hasattr(curses, 'has_colors') or \
                         not curses.has_colors():
@@ -54,10 +68,21 @@ def format_list(l):
                 ret += str(l[i])
         return ret + ' and ' + str(l[-1])
 
+_formatted_times = dict()
+
 def format_time(s):
         """ Formats a <s> seconds into <hours>:<minutes>:<seconds>,
-            nicely. """
+            nicely.  Remembers the result, for the countdowns format the
+            same seconds over and over. """
         s = int(s)
+        ret = _formatted_times.get(s)
+        if ret is None:
+                if len(_formatted_times) >= TIME_CACHE_SIZE:
+                        _formatted_times.clear()
+                ret = _formatted_times[s] = _format_time(s)
+        return ret
+
+def _format_time(s):
         if s < 0:
                 ret = '-'
                 s = abs(s)
@@ -95,6 +120,9 @@ class ScrollingColsWindow:
                 self.c_offset = 0
                 self.c_middle = 0
                 self.old_c_offset = 0
+                # What each line shows, to redraw only those that change
+                self.shadow = list()
+                self.shadow_key = None
         
         def scroll_page_up(self):
                 self.y_offset -= self.old_h
@@ -181,27 +209,50 @@ class ScrollingColsWindow:
                         self.col_ws = self._layout(avgs, w, maxs)
                 self.y_max = N
         
-        def draw_cell_text(self, val, start, end, colors):
+        def draw_cell_text(self, y, j, val, start, end, colors):
+                """ Draws <val> from <start> to <end>, the cell of column
+                    <j> on line <y> """
                 self.w.addstr(val[start:end])
         
-        def draw_cell(self, y, cx, cw, val, colors):
+        def draw_cell(self, y, j, cx, cw, val, colors):
                 self.w.move(y, cx)
                 if len(val) > cw:
                         if self.x_offset == 0:
-                                self.draw_cell_text(val, 0, cw-1, colors)
+                                self.draw_cell_text(y, j, val, 0, cw-1,
+                                                colors)
                                 self.w.addch('$', colors[1])
                         else:
                                 self.w.addch('>', colors[2])
                                 off = self.x_offset
                                 if off + cw - 2 > len(val):
                                         off = len(val) - cw + 2
-                                self.draw_cell_text(val, off, off+cw-2,
-                                                colors)
+                                self.draw_cell_text(y, j, val, off,
+                                                off+cw-2, colors)
                                 self.w.addch('$', colors[1])
                 else:
-                        self.draw_cell_text(val, 0, len(val), colors)
+                        self.draw_cell_text(y, j, val, 0, len(val), colors)
 
         
+        def _draw_col(self, y, j, cx, cw, val, colors):
+                """ Draws the cell <val> of column <j> at <cx> of width
+                    <cw> """
+                try:
+                        self.draw_cell(y, j, cx, cw, val, colors)
+                except curses.error:
+                        if y == self.w.getmaxyx()[0] - 1 and \
+                                cx + cw == sum(self.col_ws):
+                                        # curses doesn't like us
+                                        # writing to the top right:
+                                        # ignore.
+                                        pass
+                        else:
+                                try:
+                                        self.w.move(y, cx)
+                                        self.w.addch('!', colors[3])
+                                except curses.error:
+                                        # This shouldn't happen!
+                                        raise Exception, (y, cx)
+
         def draw_cols_line(self, y, cells, is_cursor):
                 """ Draws a line with columns """
                 self.w.move(y, 0)
@@ -221,22 +272,7 @@ class ScrollingColsWindow:
                                 assert cells[j] == ''
                                 continue
                         cw = self.col_ws[j]
-                        try:
-                                self.draw_cell(y, cx, cw, cells[j], colors)
-                        except curses.error:
-                                if y == self.w.getmaxyx()[0] - 1 and \
-                                        cx + cw == sum(self.col_ws):
-                                                # curses doesn't like us
-                                                # writing to the top right:
-                                                # ignore.
-                                                pass
-                                else:
-                                        try:
-                                                self.w.move(y, cx)
-                                                self.w.addch('!', colors[3])
-                                        except curses.error:
-                                                # This shouldn't happen!
-                                                raise Exception, (y, cx)
+                        self._draw_col(y, j, cx, cw, cells[j], colors)
                         cx += cw
                 if is_cursor:
                         self.w.attroff(curses_color_pair(
@@ -244,15 +280,41 @@ class ScrollingColsWindow:
 
         
         def draw_line(self, y, is_cursor):
-                """ Draws a line """
-                self.w.move(y, 0)
+                """ Draws a line, if it differs from what is shown """
                 if y + self.y_offset >= self.y_max:
+                        line = '~'
+                else:
+                        cells = self.get_cells(y + self.y_offset)
+                        line = (cells, is_cursor)
+                if self.shadow[y] == line:
+                        return
+                self.shadow[y] = line
+                self.w.move(y, 0)
+                if line == '~':
                         self.w.addstr('~', curses_color_pair(
                                         CP_BLUE))
                         self.w.clrtoeol()
                 else:
-                        cells = self.get_cells(y + self.y_offset)
                         self.draw_cols_line(y, cells, is_cursor)
+
+        def get_draw_key(self):
+                """ Should return what the drawing of a line depends on,
+                    apart from its cells """
+                return None
+
+        def _scroll(self, n):
+                """ Scrolls the shown lines <n> lines up """
+                h = len(self.shadow)
+                if abs(n) >= h:
+                        self.shadow = [UNKNOWN_LINE] * h
+                        return
+                self.w.scrollok(True)
+                self.w.scrl(n)
+                self.w.scrollok(False)
+                if n > 0:
+                        self.shadow = self.shadow[n:] + [UNKNOWN_LINE] * n
+                else:
+                        self.shadow = [UNKNOWN_LINE] * -n + self.shadow[:n]
         
         def update(self, forceRedraw=False):
                 """ Update the view """
@@ -291,7 +353,14 @@ class ScrollingColsWindow:
                         elif self.c_offset + self.y_offset >= self.y_max:
                                 self.c_offset = min(h - 1,
                                                 self.y_max - self.y_offset - 1)
-                start = time.time()
+                key = (self.col_ws and tuple(self.col_ws), self.x_offset,
+                       self.get_draw_key())
+                if forceRedraw or key != self.shadow_key or \
+                                len(self.shadow) != h:
+                        self.shadow = [UNKNOWN_LINE] * h
+                        self.shadow_key = key
+                elif self.y_offset != self.old_y_offset:
+                        self._scroll(self.y_offset - self.old_y_offset)
                 for y in xrange(h):
                         self.draw_line(y, self.use_cursor and y==self.c_offset)
                 # We update old_ here for they might've been updated
@@ -302,11 +371,13 @@ class ScrollingColsWindow:
                         self.old_c_offset = self.c_offset
                 self.w.noutrefresh()
 
-        def touch(self, layout=False):
+        def touch(self, layout=False, full=False):
                 """ Touches the window to redraw.  If <layout>, also recompute
-                    the column layout """
+                    the column layout.  If <full>, also redraw the lines
+                    that didn't change, for something was drawn over them. """
                 self.needRedraw = True
                 if layout: self.needLayout = True
+                if full: self.shadow = list()
         
         def get_view_region(self):
                 """ Return view region information: start and end of the region
@@ -314,99 +385,183 @@ class ScrollingColsWindow:
                     lines """
                 return (self.y_offset, self.y_offset + self.old_h, self.y_max)
 
+class SearchWorker(threading.Thread):
+        """ Performs the queries of a SearchWindow off the main thread.  A
+            new query cancels the one that is running.  The results are
+            handed over as soon as the first are in; the rest are pulled
+            in afterwards. """
+        def __init__(self, m, rank=False):
+                threading.Thread.__init__(self)
+                self.daemon = True
+                self.m = m
+                self.rank = rank
+                self.cond = threading.Condition()
+                self.pending = None
+                self.running = False
+                self.cancel = threading.Event()
+                self.result = None
+                self.l = logging.getLogger('SearchWorker')
+
+        def submit(self, q):
+                """ Performs the query <q> instead of the current one """
+                with self.cond:
+                        self.pending = q
+                        self.cancel.set()
+                        self.cond.notify()
+
+        def busy(self):
+                with self.cond:
+                        return self.running or not self.pending is None
+
+        def take(self):
+                """ Returns (query, results, spans) of the last finished
+                    query, if it wasn't taken before, otherwise None.  The
+                    spans are the MatchSpans of the results. """
+                with self.cond:
+                        ret, self.result = self.result, None
+                return ret
+
+        def run(self):
+                while True:
+                        with self.cond:
+                                while self.pending is None:
+                                        self.cond.wait()
+                                q, self.pending = self.pending, None
+                                self.cancel = cancel = threading.Event()
+                                self.running = True
+                        ret = None
+                        try:
+                                spans = self.m.match_spans(q)
+                                ret = self.m.query(q, rank=self.rank,
+                                                   cancel=cancel, lazy=True)
+                                with self.cond:
+                                        if not ret is None and \
+                                                        not cancel.is_set():
+                                                self.result = (q, ret, spans)
+                                while isinstance(ret, ResultView) and \
+                                                not ret.complete and \
+                                                not cancel.is_set():
+                                        ret.fill(len(ret) + SEARCH_FILL_CHUNK,
+                                                 cancel)
+                        except Exception:
+                                self.l.exception("Uncaught exception")
+                        with self.cond:
+                                self.running = False
+
 class SearchWindow(ScrollingColsWindow):
-        def __init__(self, w, m, highlight=True):
+        """ Shows the results of the query.  The queries are performed by
+            a SearchWorker; meanwhile the previous results are shown. """
+        def __init__(self, w, m, highlight=True, rank=False):
                 ScrollingColsWindow.__init__(self, w, use_cursor=True)
                 self.needDataInfoRecreate = False
                 self.data_info = None
                 self.data = None
+                # The ColumnStats of the first results of stats_data
+                self.stats = None
+                self.stats_data = None
+                # The query of which the results are shown and the
+                # MatchSpans of them
+                self.data_query = None
+                self.data_spans = None
                 self.m = m
                 self.query = None
                 self.highlight = highlight
+                self.worker = SearchWorker(m, rank=rank)
+                self.worker.start()
                 
-        def draw_cell_text(self, val, start, end, colors):
+        def draw_cell_text(self, y, j, val, start, end, colors):
                 if not self.highlight:
-                        return ScrollingColsWindow.draw_cell_text(self,
+                        return ScrollingColsWindow.draw_cell_text(self, y, j,
                                         val, start, end, colors)
-                ridx = -1
-                idxs = [0]
-                val_lower = val.lower()
-                while True:
-                        ridx = val_lower.find(self.query, ridx+1)
-                        if ridx == -1:
+                pos = start
+                for s, e in self.data_spans[self.data[y + self.y_offset]][j]:
+                        if e <= pos:
+                                continue
+                        if s >= end:
                                 break
-                        if ridx < idxs[-1]:
-                                idxs[-1] = ridx + len(self.query)
-                        else:
-                                idxs.append(ridx)
-                                idxs.append(ridx + len(self.query))
-                idxs.append(len(val))
-                v = list(idxs)
-                v.sort()
-                assert v == idxs
-                m = True
-                for i in xrange(0, len(idxs)-1):
-                        m = not m
-                        istart, iend = idxs[i:i+2]
-                        if end <= istart: continue
-                        if iend <= start: continue
-                        istart = max(istart, start)
-                        iend = min(iend, end)
-                        if istart == iend: continue
-                        self.w.attron(colors[3 if m else 0])
-                        self.w.addstr(val[istart:iend])
-                        self.w.attroff(colors[3 if m else 0])
+                        if s > pos:
+                                self.w.addstr(val[pos:s], colors[0])
+                        e = min(e, end)
+                        self.w.addstr(val[max(s, pos):e], colors[3])
+                        pos = e
+                if pos < end:
+                        self.w.addstr(val[pos:end], colors[0])
         
         def set_query(self, q):
                 if self.query == q:
                         return
                 self.query = q
-                self.data = None
+                self.search()
+
+        def search(self):
+                """ Starts performing the query """
+                if self.m.songs_fetched and not self.query is None:
+                        self.worker.submit(self.query)
+
+        def searching(self):
+                """ Whether a query is being performed """
+                return self.worker.busy()
+
+        def poll(self):
+                """ Shows the results of the query, if they are in, or
+                    more of them.  Returns whether there were. """
+                result = self.worker.take()
+                if result is None:
+                        if self.data is None or self.data_info is None or \
+                                        len(self.data) == self.data_info[0]:
+                                return False
+                else:
+                        self.data_query, self.data, self.data_spans = result
                 self.needDataInfoRecreate = True
+                self.touch(layout=True)
+                return True
         
-        def touch(self, layout=False, data=False):
+        def touch(self, layout=False, data=False, full=False):
+                """ Touches the window.  If <data>, the query is performed
+                    again, for the songs changed. """
                 if data:
-                        self.needDataInfoRecreate = True
-                ScrollingColsWindow.touch(self, layout=layout)
-        
-        def fetch_data(self):
-                return self.m.query(self.query)
+                        self.search()
+                ScrollingColsWindow.touch(self, layout=layout, full=full)
+
+        def get_draw_key(self):
+                return (self.highlight, self.data_query)
 
         def get_data_info(self):
                 if self.data is None:
-                        if not self.m.songs_fetched:
-                                return None
-                        self.data = self.fetch_data()
+                        return None
                 if len(self.data) == 0:
                         return None
-                if self.data_info is None or \
-                                self.needDataInfoRecreate:
+                if self.data_info is None or self.needDataInfoRecreate:
                         self.needDataInfoRecreate = False
-                        self.data_info = None
-                if self.data_info is None:
                         self.data_info = self.create_data_info()
                 return self.data_info
         
         def create_data_info(self):
+                # The widths don't depend on the order: don't make ranked
+                # results sort themselves, nor pull in lazy ones.  Many
+                # results are laid out as all songs are; only the cells of
+                # at most STATS_SAMPLE are measured, as they come in.
                 N = len(self.data)
-                l = len(self.get_cells(0))
-                sums = [0]*l
-                maxs = [0]*l
-                for i in xrange(N):
-                        cells = self.get_cells(i)
-                        for j in xrange(l):
-                                sums[j] += len(cells[j])
-                                maxs[j] = max(len(cells[j]), maxs[j])
-                return (N, map(lambda x: x/N, sums), maxs)
+                if N > STATS_SAMPLE and not self.m.songs_stats is None:
+                        return (N,) + self.m.songs_stats.info()[1:]
+                if self.stats_data is not self.data:
+                        self.stats_data = self.data
+                        self.stats = ColumnStats(2)
+                ids = getattr(self.data, 'ids', self.data)
+                for i in xrange(self.stats.N, min(len(ids), STATS_SAMPLE)):
+                        self.stats.add(self._cells(ids[i]))
+                return (N,) + self.stats.info()[1:]
+
+        def _cells(self, track_id):
+                return self.m.songs[track_id]
 
         def get_cells(self, j):
-                return (self.m.songs[self.data[j]][0],
-                        self.m.songs[self.data[j]][1])
+                return self._cells(self.data[j])
         
         def request_track(self):
                 """ Requests the track under the cursor """
                 cpos = self.c_offset + self.y_offset
-                if len(self.data) == 0: return
+                if not self.data: return
                 track_id = self.data[cpos]
                 self.m.request_track(track_id)
                         
@@ -418,26 +573,40 @@ class QueueWindow(ScrollingColsWindow):
                 self.data_info = None
                 self.needDataInfoRecreate = False
                 self.time_lut = None
-                self.last_redraw = 0
+                self.now = time.time()
+                # The ColumnStats of the rows without their time, which
+                # changes every second, and how often each is in it
+                self.stats = None
+                self.rows = dict()
         
         def create_data_info(self):
                 # Sometimes self.m.queue doesn't exist
                 N = len(self.m.queue) + 1
-                l = len(self.get_cells(0))
-                sums = [0]*l
-                maxs = [0]*l
+                rows = dict()
+                time_sum = time_max = 0
                 for i in xrange(N):
                         cells = self.get_cells(i)
-                        for j in xrange(l):
-                                sums[j] += len(cells[j])
-                                maxs[j] = max(len(cells[j]), maxs[j])
-                return (N, map(lambda x: x/N, sums), maxs)
+                        rows[cells[:-1]] = rows.get(cells[:-1], 0) + 1
+                        time_sum += len(cells[-1])
+                        time_max = max(time_max, len(cells[-1]))
+                if self.stats is None:
+                        self.stats = ColumnStats(len(self.get_cells(0)) - 1)
+                # Only count the rows that were added or removed
+                for cells, n in self.rows.iteritems():
+                        for i in xrange(n - rows.get(cells, 0)):
+                                self.stats.remove(cells)
+                for cells, n in rows.iteritems():
+                        for i in xrange(n - self.rows.get(cells, 0)):
+                                self.stats.add(cells)
+                self.rows = rows
+                N, avgs, maxs = self.stats.info()
+                return (N, avgs + [time_sum / N], maxs + [time_max])
         
         def _nowPlaying_line(self):
                 """ Returns the line containing the currently playing song """
                 if len(self.m.queue) == 0:
                         timeLeft = format_time(int(self.m.queueOffsetTime - \
-                                        time.time()))
+                                        self.now))
                 else:
                         # The countdown on the first queued song would equal
                         # <timeleft>.
@@ -459,7 +628,7 @@ class QueueWindow(ScrollingColsWindow):
                 if self.time_lut is None:
                         t = format_time(self.m.queue[l][2])
                 else:
-                        t = format_time(int(self.time_lut[l] - time.time()))
+                        t = format_time(int(self.time_lut[l] - self.now))
                 return (self.m.queue[l][3],
                         self.m.queue[l][0],
                         self.m.queue[l][1],
@@ -504,18 +673,52 @@ class QueueWindow(ScrollingColsWindow):
                 self.data_info = None
         
         def update(self, forceRedraw=False):
-                """ Overload update to keep track of the updates to allow
-                    per-second reloads if we've got countdowns to update """
-                if not forceRedraw and not self.time_lut is None and \
-                                (time.time() - self.last_redraw) > 0.7:
-                        self.needRedraw = True
-                self.last_redraw = time.time()
+                """ Overload update to also rewrite the countdowns """
+                self.now = time.time()
                 ScrollingColsWindow.update(self, forceRedraw)
+                self.tick()
+
+        def tick(self):
+                """ Rewrites the time cells of the shown lines of which
+                    the countdown changed """
+                if self.time_lut is None or self.col_ws is None or \
+                                len(self.shadow) != self.old_h:
+                        return
+                cx = sum(self.col_ws[:-1])
+                cw = self.col_ws[-1]
+                colors = map(curses_color_pair,
+                                [CP_WHITE, CP_BLUE, CP_GREEN, CP_RED])
+                changed = False
+                for y in xrange(min(self.old_h, self.y_max - self.y_offset)):
+                        line = self.shadow[y]
+                        if line is UNKNOWN_LINE or line == '~':
+                                continue
+                        cells = self.get_cells(y + self.y_offset)
+                        if cells == line[0]:
+                                continue
+                        changed = True
+                        if cells[:-1] != line[0][:-1] or cw == 0:
+                                self.draw_line(y, False)
+                                continue
+                        self.shadow[y] = (cells, False)
+                        self.w.hline(y, cx, ' ', cw)
+                        self._draw_col(y, len(cells) - 1, cx, cw, cells[-1],
+                                       colors)
+                if changed:
+                        self.w.noutrefresh()
+
+        def next_tick(self):
+                """ Returns the number of seconds until the countdown of
+                    the playing track changes, or None if there are no
+                    countdowns.  The others are rewritten along with it. """
+                if self.time_lut is None:
+                        return None
+                return (self.m.queueOffsetTime - time.time()) % 1.0
         
-        def touch(self, layout=False, data=False):
+        def touch(self, layout=False, data=False, full=False):
                 if data:
                         self.needDataInfoRecreate = True
-                ScrollingColsWindow.touch(self, layout=layout)
+                ScrollingColsWindow.touch(self, layout=layout, full=full)
 
 class CursesMarietje:
         def __init__(self, host, port, userdir):
@@ -546,20 +749,31 @@ class CursesMarietje:
                         self.options['marietje'] = dict()
                 if not 'username' in self.options['marietje']:
                         self.options['marietje']['username'] = os.getlogin()
+                if not 'search-engine' in self.options['marietje']:
+                        self.options['marietje']['search-engine'] = \
+                                        DEFAULT_LS_ENGINE
+                if not 'search-fold' in self.options['marietje']:
+                        self.options['marietje']['search-fold'] = True
+                if not 'watch' in self.options['marietje']:
+                        self.options['marietje']['watch'] = True
 
                 self.m = Marietje(self.options['marietje']['username'],
                                 queueCb=self.on_queue_fetched,
                                 songCb=self.on_songs_fetched,
+                                songProgressCb=self.on_songs_progress,
                                 playingCb=self.on_playing_fetched,
                                 host=host,
-                                port=port)
+                                port=port,
+                                engine=self.options['marietje'][
+                                                'search-engine'],
+                                fold=self.options['marietje']['search-fold'])
                 self.l = logging.getLogger('CursesMarietje')
 
                 if not self.userdir is None:
                         fp = os.path.join(self.userdir, 'songs-cache')
                         if os.path.exists(fp):
                                 try:
-                                        with open(fp) as f:
+                                        with open(fp, 'rb') as f:
                                                 self.m.songs_from_cache(f)
                                 except Exception, e:
                                         self.l.exception("Exception while "+
@@ -622,15 +836,23 @@ class CursesMarietje:
                                     "%(name)s:%(levelname)s:%(message)s")
                 self._been_setup = False
                 self.running = True
+                if self.options['marietje']['watch']:
+                        self.m.start_watch()
                 while self.running:
                         curses.wrapper(self._inside_curses)
+                self.m.stop_watch()
                 if not self.userdir is None:
                         with open(os.path.join(self.userdir,
                                         'config'), 'w') as f:
                                 self.options = yaml.dump(self.options, f)
-                        with open(os.path.join(self.userdir, 
-                                        'songs-cache'), 'w') as f:
+                        if not self.m.songs_fetched or self.m.songs_partial:
+                                return
+                        # The current songs might be mapped from the old
+                        # cache: write the new one next to it.
+                        fp = os.path.join(self.userdir, 'songs-cache')
+                        with open(fp + '.new', 'wb') as f:
                                 self.m.cache_songs_to(f)
+                        os.rename(fp + '.new', fp)
         
         def _inside_curses(self, window):
                 if not self._been_setup:
@@ -660,9 +882,13 @@ class CursesMarietje:
                         self.options['search-window'] = dict()
                 if not 'highlight' in self.options['search-window']:
                         self.options['search-window']['highlight'] = True
+                if not 'rank' in self.options['search-window']:
+                        self.options['search-window']['rank'] = False
                 self.search_main = SearchWindow(self.window.derwin(h-1,w,0,0),
                                         self.m, highlight=self.options[
-                                                'search-window']['highlight'])
+                                                'search-window']['highlight'],
+                                        rank=self.options[
+                                                'search-window']['rank'])
                 self.status_w = self.window.derwin(1, w, h-1, 0)
                 self.main = self.queue_main
                 self.refetch(force=True)
@@ -671,7 +897,19 @@ class CursesMarietje:
                 window = self.window
                 h,w = self.window.getmaxyx()
                 while True:
-                        if self.update_timeout:
+                        tick = None
+                        if self.main is self.queue_main:
+                                tick = self.queue_main.next_tick()
+                        if self.search_main.searching():
+                                # Poll often for the results
+                                window.timeout(SEARCH_TIMEOUT)
+                                self.update_timeout = True
+                        elif not tick is None and \
+                                        tick * 1000 < self.timeout:
+                                # Wake up when the countdowns change
+                                window.timeout(int(tick * 1000) + TICK_MARGIN)
+                                self.update_timeout = True
+                        elif self.update_timeout:
                                 self.update_timeout = False
                                 window.timeout(self.timeout)
                         try:
@@ -779,7 +1017,9 @@ class CursesMarietje:
                                         self.l.exception("Exception while "+
                                                         "requesting track")
                                         self.set_status(str(e))
-                                self.refetch(fetchSongs=False)
+                                # The watcher fetches the queue on a request
+                                if self.m.watch_thread is None:
+                                        self.refetch(fetchSongs=False)
                                 self.query = ''
                         elif 0 < k and k < 128 and \
                                         chr(k).lower() in self.m.cs_lut:
@@ -791,13 +1031,14 @@ class CursesMarietje:
                         if self.main is self.queue_main \
                                         and len(self.query) != 0:
                                 self.main = self.search_main
-                                self.main.touch()
+                                self.main.touch(full=True)
                         elif self.main is self.search_main \
                                         and len(self.query) == 0:
                                 self.main = self.queue_main
-                                self.main.touch()
+                                self.main.touch(full=True)
                         
-                        if self.main is self.queue_main:
+                        if self.main is self.queue_main and \
+                                        self.m.watch_thread is None:
                                 if self.m.playing_fetched and \
                                                 time.time() > self.m.queueOffsetTime:
                                         self.refetch(fetchSongs=False)
@@ -808,7 +1049,7 @@ class CursesMarietje:
                                 self.refresh_status = True
                                 if self.main is self.search_main:
                                         self.search_main.set_query(self.query)
-                                        self.search_main.touch(layout=True)
+                        self.search_main.poll()
                                 
                         self.main.update(forceRedraw=forceRedraw)
                         self.update_status(forceRedraw=forceRedraw)
@@ -832,7 +1073,7 @@ class CursesMarietje:
                         return
                 h, w = self.status_w.getmaxyx()
                 self.refresh_status = False
-                self.status_w.clear()
+                self.status_w.erase()
                 pos = '%s-%s|%s' % self.main.get_view_region()
                 if len(pos) < w:
                         self.status_w.addstr(0, w-len(pos)-1, pos)
@@ -872,12 +1113,21 @@ class CursesMarietje:
                         self.timeout = DEFAULT_TIMEOUT
                         self.update_timeout = True
                 self.queue_main.touch(layout=True, data=True)
+                self.search_main.touch(layout=True, data=True)
                 if from_cache:
                         self.set_status("Songs (cache) in %s" % self.m.sCacheLoadTime)
                 else:
                         if not hasattr(self.m, 'sLoadTime'): return
                         self.set_status("Songs in %s" % self.m.sLoadTime)
         
+        def on_songs_progress(self, fetched, total):
+                if not self.running:
+                        return
+                self.set_status("Songs %s/%s" % (fetched, total))
+                if self.m.songs_partial:
+                        self.queue_main.touch(layout=True, data=True)
+                        self.search_main.touch(layout=True, data=True)
+
         def on_playing_fetched(self):
                 if not self.m.playing_fetched:
                         self.set_status("Playing fetch failed: %s" % \
@@ -1,4 +1,31 @@
+import sys
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import imap, izip
+from operator import itemgetter
+
+SA_SEPARATOR = '\n'
+# Number of entries scanned between checks for cancellation
+CANCEL_CHUNK = 4096
+# The minimal length of a word in a query to allow one, respectively two,
+# typos in it with the FuzzyLSTree
+FUZZY_LENGTHS = (5, 8)
+
+def pack_arrays(d):
+        """ Returns the dict <d> of arrays with the arrays replaced by their
+            typecode and raw bytes: arrays pickle as lists of ints. """
+        return dict([(k, v.typecode + v.tostring())
+                        for k, v in d.iteritems()])
+
+def unpack_arrays(d):
+        """ Reverses pack_arrays """
+        ret = dict()
+        for k, v in d.iteritems():
+                a = array(v[0])
+                a.fromstring(v[1:])
+                ret[k] = a
+        return ret
 
 class LSTree(object):
         """ Base class ofa Live Search Tree """
@@ -9,55 +36,724 @@ class LSTree(object):
                 """
                 raise NotImplemented
 
-        def query(self, q):
+        def query(self, q, cancel=None):
                 """ Finds all entries (text, obj) with q in text and returns
-                    the obj's. """
-                raise NotImplemented
+                    the obj's.  Long scans stop early when the
+                    threading.Event <cancel> is set; the results are
+                    incomplete then. """
+                return imap(itemgetter(1), self.query_entries(q, cancel))
+
+        def query_entries(self, q, cancel=None):
+                """ Like query, but returns the entries (text, obj) """
+                raise NotImplementedError
 
         def prune(self):
                 """ Take some effort to optimize.  Used before being
                     cached """
                 pass
 
+        def spans(self, q, txt):
+                """ Returns the (start, end) spans of the matches of q in
+                    the text of an entry, by which query found it """
+                ret = list()
+                if q == '':
+                        return ret
+                i = txt.find(q)
+                while i != -1:
+                        ret.append((i, i + len(q)))
+                        i = txt.find(q, i + 1)
+                return ret
+
+        def entries(self):
+                """ Returns all entries (text, obj) in order """
+                raise NotImplementedError
+
+        def update(self, added, removed):
+                """ Adds the entries (text, obj) in <added> and removes the
+                    entries in <removed>.  Raises NotImplementedError,
+                    without changing anything, if the tree can't be
+                    updated in place. """
+                raise NotImplementedError
+
 class SimpleCachingLSTree(LSTree):
         """ Simple implementation of LSTree, which caches """
 
-        def __init__(self, entries, _cmp, max_cache=10, nom_cache=7):
+        def __init__(self, entries, _cmp, max_cache=10, nom_cache=7,
+                        max_size=None):
                 """ Creates a LS Tree
                         @entries        List of (text, obj) pairs
                         @max_cache      Maximum amount of cache entries
                         @nom_cache      When maximum cache size is reached,
                                         evict entries up to @nom_cache
+                        @max_size       Maximum total length of the cached
+                                        results; by default twice the
+                                        number of entries
                 """
+                self._set_root(sorted(entries, cmp=_cmp))
+                # query -> [lastUsed, buildTime, indices into root]
                 self.cache = dict()
-                
-                self.cache[''] =  [time.time(), 0.0, sorted(entries, cmp=_cmp)]
+                self._cmp = _cmp
                 self.max_cache = max_cache
                 self.nom_cache = nom_cache
-        
-        def query(self, q):
-                for i in xrange(0, len(q)+1):
-                        if i == 0:
-                                if q in self.cache:
-                                        break
-                                continue
-                        if not q[:-i] in self.cache:
+                self.max_size = max_size
+
+        def _set_root(self, entries):
+                """ Sets the root to the sorted <entries>.  It is kept as
+                    the lists of their texts and of their objs, which are
+                    far quicker to scan, and replaced at once. """
+                objs = [obj for txt, obj in entries]
+                # Without duplicate objs, the results need no dedupe
+                self.unique = len(set(objs)) == len(objs)
+                self.root = ([txt for txt, obj in entries], objs)
+
+        def query(self, q, cancel=None):
+                return self._results(q, cancel, False)
+
+        def query_entries(self, q, cancel=None):
+                return self._results(q, cancel, True)
+
+        def _results(self, q, cancel, entries):
+                """ Yields the objs, or if <entries> the entries, of the
+                    indices yielded by _find """
+                # update() replaces the root and the cache: the indices
+                # are into the root as it was.
+                root = self.root
+                texts, objs = root
+                dup_lut = None if self.unique else set()
+                for found in self._find(q, cancel, root):
+                        if dup_lut is None and not entries:
+                                for obj in imap(objs.__getitem__, found):
+                                        yield obj
                                 continue
-                        self.cache[q] = [time.time(), None, list()]
+                        for j in found:
+                                obj = objs[j]
+                                if not dup_lut is None:
+                                        if obj in dup_lut:
+                                                continue
+                                        dup_lut.add(obj)
+                                yield (texts[j], obj) if entries else obj
+
+        def _find(self, q, cancel, root):
+                """ Yields lists of the indices into <root> of the texts
+                    with <q>, in order, as they are found """
+                texts = root[0]
+                cache = self.cache
+                if q == '':
+                        yield xrange(len(texts))
+                        return
+                if q in cache:
+                        c = cache[q]
+                        c[0] = time.time()
+                        yield c[2]
+                        return
+                # Filter the results of the longest cached prefix
+                base = None
+                for i in xrange(1, len(q)):
+                        if q[:-i] in cache:
+                                base = cache[q[:-i]][2]
+                                break
+                # The time spent scanning, not waiting for the consumer
+                buildTime = 0
+                n = len(texts) if base is None else len(base)
+                idxs = array('i')
+                for k in xrange(0, n, CANCEL_CHUNK):
+                        if cancel is not None and cancel.is_set():
+                                return
                         start = time.time()
-                        for txt, obj in self.cache[q[:-i]][2]:
-                                if q in txt:
-                                        self.cache[q][2].append((txt, obj))
-                        self.cache[q][1] = time.time() - start
-                self.cache[q][0] = time.time()
+                        if base is None:
+                                found = [j for j, txt in enumerate(
+                                                texts[k:k + CANCEL_CHUNK], k)
+                                        if q in txt]
+                        else:
+                                found = [j for j in base[k:k + CANCEL_CHUNK]
+                                        if q in texts[j]]
+                        idxs.extend(found)
+                        buildTime += time.time() - start
+                        yield found
+                # Only complete results are cached
+                if not root is self.root:
+                        return
+                cache[q] = [time.time(), buildTime, idxs]
+                if cache is self.cache:
+                        self._evict(q)
+
+        def _evict(self, keep):
+                """ If there are more than max_cache entries or their size
+                    exceeds max_size, evicts entries until there are at
+                    most nom_cache left and their size is below max_size.
+                    The entries that took the least time to build per
+                    result and that are least recently used go first.
+                    <keep> isn't evicted. """
+                max_size = self.max_size
+                if max_size is None:
+                        max_size = 2 * len(self.root[0])
+                size = sum([len(c[2]) for c in self.cache.itervalues()])
+                if len(self.cache) <= self.max_cache and size <= max_size:
+                        return
+                now = time.time()
+                def value(q):
+                        lastUsed, buildTime, idxs = self.cache[q]
+                        return buildTime / (len(idxs) + 1) / \
+                                        (now - lastUsed + 1)
+                for q in sorted(self.cache, key=value):
+                        if len(self.cache) <= self.nom_cache and \
+                                        size <= max_size:
+                                break
+                        if q == keep:
+                                continue
+                        size -= len(self.cache[q][2])
+                        del self.cache[q]
+
+        def prune(self):
+                self.cache = dict()
+
+        def entries(self):
+                return izip(*self.root)
+
+        def update(self, added, removed):
+                # We build new lists, for running queries might still
+                # iterate over the old ones.  The cached results are indices
+                # into them, so they are dropped.
+                removed = set(removed)
+                root = [e for e in self.entries() if not e in removed]
+                root.extend(added)
+                root.sort(cmp=self._cmp)
+                self.cache = dict()
+                self._set_root(root)
+
+class NGramLSTree(LSTree):
+        """ Implementation of LSTree backed by an inverted index on the
+            n-grams of the texts """
+
+        def __init__(self, entries, _cmp, n=3):
+                """ Creates a LS Tree
+                        @entries        List of (text, obj) pairs
+                        @n              Length of the indexed grams
+                """
+                self.n = n
+                self._cmp = _cmp
+                self.sorted_entries = sorted(entries, cmp=_cmp)
+                # Entries added by update() are appended to sorted_entries
+                # and removed entries are replaced by None.
+                self.nsorted = len(self.sorted_entries)
+                self.objs = [obj for txt, obj in self.sorted_entries]
+                # Whether the entries are as built and their objs are
+                # distinct, such that the results of a posting list are
+                # its objs
+                self.plain = len(set(self.objs)) == len(self.objs)
+                postings = dict()
+                for i, (txt, obj) in enumerate(self.sorted_entries):
+                        for g in self._all_grams(txt):
+                                if not g in postings:
+                                        postings[g] = list()
+                                postings[g].append(i)
+                # Posting lists are sorted indices into self.sorted_entries.
+                # There are lists for the shorter grams too, which answer
+                # the queries shorter than n exactly.
+                self.postings = dict()
+                for g, p in postings.iteritems():
+                        self.postings[g] = array('i', p)
+
+        def _grams(self, txt):
+                return set([txt[j:j+self.n]
+                                for j in xrange(len(txt) - self.n + 1)])
+
+        def _all_grams(self, txt):
+                """ Returns the grams of <txt> of at most n characters """
+                return set([txt[j:j+l] for l in xrange(1, self.n + 1)
+                                for j in xrange(len(txt) - l + 1)])
+
+        def _candidates(self, q):
+                """ Returns the sorted indices of the entries that might
+                    contain <q> and whether they still need to be checked """
+                if len(q) < self.n:
+                        return self.postings.get(q, ()), False
+                ps = list()
+                for g in self._grams(q):
+                        if not g in self.postings:
+                                return (), False
+                        ps.append(self.postings[g])
+                ps.sort(key=len)
+                if len(ps) == 1:
+                        return ps[0], len(q) != self.n
+                # Intersect the rarest posting list with the next rarest
+                # ones by binary search.  The remaining grams are checked
+                # by the final substring test.
+                ret = ps[0]
+                for p in ps[1:3]:
+                        ret2 = list()
+                        for i in ret:
+                                k = bisect_left(p, i)
+                                if k != len(p) and p[k] == i:
+                                        ret2.append(i)
+                        ret = ret2
+                return ret, True
+
+        def query(self, q, cancel=None):
+                if self.plain:
+                        if q == '':
+                                return iter(self.objs)
+                        idxs, check = self._candidates(q)
+                        if not check:
+                                return imap(self.objs.__getitem__, idxs)
+                return LSTree.query(self, q, cancel)
+
+        def query_entries(self, q, cancel=None):
+                if q == '':
+                        idxs = xrange(len(self.sorted_entries))
+                        check = False
+                else:
+                        idxs, check = self._candidates(q)
+                if len(self.sorted_entries) != self.nsorted:
+                        # Some entries were appended by update()
+                        idxs = self._sort_idxs(idxs)
+                dup_lut = set()
+                for i in idxs:
+                        e = self.sorted_entries[i]
+                        if e is None:
+                                continue
+                        txt, obj = e
+                        if check and not q in txt:
+                                continue
+                        if obj in dup_lut:
+                                continue
+                        dup_lut.add(obj)
+                        yield e
+
+        def _sort_idxs(self, idxs):
+                idxs = [i for i in idxs if self.sorted_entries[i] is not None]
+                idxs.sort(cmp=self._cmp, key=self.sorted_entries.__getitem__)
+                return idxs
+
+        def update(self, added, removed):
+                self.plain = False
+                for e in removed:
+                        txt, obj = e
+                        if txt == '':
+                                idxs = xrange(len(self.sorted_entries))
+                        else:
+                                idxs, check = self._candidates(txt)
+                        for i in idxs:
+                                if self.sorted_entries[i] == e:
+                                        self.sorted_entries[i] = None
+                                        break
+                for e in added:
+                        i = len(self.sorted_entries)
+                        self.sorted_entries.append(e)
+                        # Appending keeps the posting lists sorted
+                        for g in self._all_grams(e[0]):
+                                if not g in self.postings:
+                                        self.postings[g] = array('i')
+                                self.postings[g].append(i)
+
+        def __getstate__(self):
+                state = dict(self.__dict__)
+                state['postings'] = pack_arrays(self.postings)
+                return state
+
+        def __setstate__(self, state):
+                state['postings'] = unpack_arrays(state['postings'])
+                self.__dict__.update(state)
+
+        def entries(self):
+                idxs = xrange(len(self.sorted_entries))
+                if len(self.sorted_entries) != self.nsorted:
+                        idxs = self._sort_idxs(idxs)
+                for i in idxs:
+                        e = self.sorted_entries[i]
+                        if e is not None:
+                                yield e
+
+def _suffix_array(text):
+        """ Returns the positions in <text> of its characters but the
+            SA_SEPARATORs, sorted on the text from there up to and
+            including the next SA_SEPARATOR.  Built by prefix doubling:
+            the positions are grouped on their first two characters, and
+            every round the groups of positions that share their first h
+            characters are split on the group of the position h further,
+            such that they share 2h.  Groups that reach a separator are
+            done, for their order is of no concern. """
+        n = len(text)
+        # The first two characters at each position, as an int that orders
+        # as they do
+        firsts = [0] * n
+        padded = text + SA_SEPARATOR * 3
+        for k in xrange(2):
+                a = array('H')
+                a.fromstring(padded[k:k + 2 * ((n - k + 1) // 2)])
+                if sys.byteorder == 'little':
+                        a.byteswap()
+                firsts[k::2] = a.tolist()
+        sa = sorted(xrange(n), key=firsts.__getitem__)
+        ks = map(firsts.__getitem__, sa)
+        bounds = [0] + [i for i in xrange(1, n) if ks[i] != ks[i-1]] + [n]
+        del ks
+        # rank[p] is the index in sa of the first position of the group of
+        # position p, such that the ranks order the groups.
+        starts = dict([(firsts[sa[i]], i) for i in bounds[:-1]])
+        rank = array('i', map(starts.__getitem__, firsts))
+        del firsts, starts
+        groups = [(bounds[k], bounds[k+1]) for k in xrange(len(bounds) - 1)
+                        if bounds[k+1] - bounds[k] > 1 and text.find(
+                                SA_SEPARATOR, sa[bounds[k]],
+                                sa[bounds[k]] + 2) == -1]
+        del bounds
+        h = 2
+        while groups:
+                # The ranks h further as they were before the round, such
+                # that all positions are compared on their first h
+                # characters
+                later = rank[h:]
+                todo = list()
+                for start, end in groups:
+                        ps = sa[start:end]
+                        ks = map(later.__getitem__, ps)
+                        if end - start == 2:
+                                if ks[0] == ks[1]:
+                                        if text.find(SA_SEPARATOR, ps[0],
+                                                     ps[0] + 2 * h) == -1:
+                                                todo.append((start, end))
+                                        continue
+                                if ks[0] > ks[1]:
+                                        ps.reverse()
+                                        sa[start:end] = ps
+                                rank[ps[1]] = start + 1
+                                continue
+                        order = sorted(xrange(len(ps)), key=ks.__getitem__)
+                        ps = sa[start:end] = map(ps.__getitem__, order)
+                        ks = map(ks.__getitem__, order)
+                        # Split on equal keys
+                        bounds = [k for k in xrange(1, len(ks))
+                                        if ks[k] != ks[k-1]]
+                        bounds.append(len(ks))
+                        k = 0
+                        for l in bounds:
+                                if l - k == 1:
+                                        rank[ps[k]] = start + k
+                                else:
+                                        map(rank.__setitem__, ps[k:l],
+                                            [start + k] * (l - k))
+                                        if text.find(SA_SEPARATOR, ps[k],
+                                                     ps[k] + 2 * h) == -1:
+                                                todo.append((start + k,
+                                                             start + l))
+                                k = l
+                groups = todo
+                h *= 2
+        return array('i', [p for p in sa if text[p] != SA_SEPARATOR])
+
+class SuffixArrayLSTree(LSTree):
+        """ Implementation of LSTree backed by a suffix array over the
+            concatenation of all texts """
+
+        def __init__(self, entries, _cmp):
+                """ Creates a LS Tree
+                        @entries        List of (text, obj) pairs
+                """
+                entries = sorted(entries, cmp=_cmp)
+                self.text = ''.join([txt + SA_SEPARATOR
+                                        for txt, obj in entries])
+                # The start of each text in self.text, by which a suffix
+                # is traced back to its entry
+                self.starts = array('i')
+                start = 0
+                for txt, obj in entries:
+                        self.starts.append(start)
+                        start += len(txt) + 1
+                try:
+                        self.objs = array('i', [obj for txt, obj in entries])
+                except (TypeError, OverflowError):
+                        self.objs = [obj for txt, obj in entries]
+                self.sa = _suffix_array(self.text)
+
+        def _range(self, q):
+                """ Returns the range of the suffix array of the suffixes
+                    that start with <q> """
+                text, sa, l = self.text, self.sa, len(q)
+                lo, hi = 0, len(sa)
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if text[sa[mid]:sa[mid]+l] < q:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                start = lo
+                hi = len(sa)
+                while lo < hi:
+                        mid = (lo + hi) // 2
+                        if text[sa[mid]:sa[mid]+l] <= q:
+                                lo = mid + 1
+                        else:
+                                hi = mid
+                return start, lo
+
+        def _indices(self, q):
+                """ Yields the indices of the entries with <q> in their
+                    text, but of the first with each obj only """
+                if q == '':
+                        idxs = xrange(len(self.objs))
+                else:
+                        start, end = self._range(q)
+                        starts = self.starts
+                        idxs = sorted(set([bisect_right(starts, j) - 1
+                                        for j in self.sa[start:end]]))
                 dup_lut = set()
-                for txt, obj in self.cache[q][2]:
+                for i in idxs:
+                        obj = self.objs[i]
                         if obj in dup_lut:
                                 continue
                         dup_lut.add(obj)
-                        yield obj
-        
+                        yield i
+
+        def _entry(self, i):
+                start = self.starts[i]
+                end = self.text.index(SA_SEPARATOR, start)
+                return (self.text[start:end], self.objs[i])
+
+        def query(self, q, cancel=None):
+                return imap(self.objs.__getitem__, self._indices(q))
+
+        def query_entries(self, q, cancel=None):
+                return imap(self._entry, self._indices(q))
+
+        def entries(self):
+                return imap(self._entry, xrange(len(self.objs)))
+
+        def __getstate__(self):
+                state = dict(self.__dict__)
+                arrays = dict([(k, state.pop(k)) for k in ('starts', 'sa',
+                                'objs') if isinstance(state[k], array)])
+                state['arrays'] = pack_arrays(arrays)
+                return state
+
+        def __setstate__(self, state):
+                state.update(unpack_arrays(state.pop('arrays')))
+                self.__dict__.update(state)
+
+def _deletions(s, k, min_len):
+        """ Returns the strings of at least <min_len> characters that are
+            obtained by deleting at most <k> characters from <s> """
+        ret = set([s])
+        level = ret
+        for i in xrange(k):
+                level = set([w[:j] + w[j+1:] for w in level
+                                for j in xrange(len(w))
+                                if len(w) > min_len])
+                ret |= level
+        return ret
+
+def _distance(a, b, k):
+        """ Returns the optimal string alignment distance (Levenshtein
+            with transpositions) between <a> and <b>, or k + 1 if it is
+            larger than <k> """
+        if abs(len(a) - len(b)) > k:
+                return k + 1
+        prev2 = None
+        prev = range(len(b) + 1)
+        for i in xrange(1, len(a) + 1):
+                cur = [i] + [0] * len(b)
+                for j in xrange(1, len(b) + 1):
+                        d = min(prev[j] + 1, cur[j-1] + 1,
+                                prev[j-1] + (a[i-1] != b[j-1]))
+                        if i > 1 and j > 1 and a[i-1] == b[j-2] and \
+                                        a[i-2] == b[j-1]:
+                                d = min(d, prev2[j-2] + 1)
+                        cur[j] = d
+                if min(cur) > k:
+                        return k + 1
+                prev2, prev = prev, cur
+        return min(prev[-1], k + 1)
+
+class FuzzyLSTree(LSTree):
+        """ Implementation of LSTree that also finds the entries with a
+            word within a few typos of the query.  The exact substring
+            matches are found by another LSTree and come first; the
+            candidate words are found with a deletion-neighbourhood
+            index (SymSpell) on their first characters. """
+
+        def __init__(self, entries, _cmp, exact=NGramLSTree, max_dist=2,
+                        prefix=7):
+                """ Creates a LS Tree
+                        @entries        List of (text, obj) pairs
+                        @exact          The LSTree class for the exact
+                                        matches
+                        @max_dist       Maximum number of typos in a word
+                        @prefix         Only the first @prefix characters
+                                        of the words are indexed
+                """
+                self.exact = exact(entries, _cmp=_cmp)
+                self.max_dist = max_dist
+                self.prefix = prefix
+                self.sorted_entries = sorted(entries, cmp=_cmp)
+                # word -> indices of the entries with the word
+                words = dict()
+                for i, (txt, obj) in enumerate(self.sorted_entries):
+                        for w in set(txt.split()):
+                                if not w in words:
+                                        words[w] = array('i')
+                                words[w].append(i)
+                self.words = words
+                # prefix of a word -> the words
+                self.prefixes = dict()
+                for w in words:
+                        p = w[:prefix]
+                        if not p in self.prefixes:
+                                self.prefixes[p] = list()
+                        self.prefixes[p].append(w)
+                # deletion of a prefix -> the prefixes, separated by
+                # newlines, for a str is far smaller than a list
+                deletions = dict()
+                min_len = FUZZY_LENGTHS[0] - max_dist
+                for p in self.prefixes:
+                        for d in _deletions(p, max_dist, min_len):
+                                if not d in deletions:
+                                        deletions[d] = list()
+                                deletions[d].append(p)
+                self.deletions = dict()
+                for d, ps in deletions.iteritems():
+                        self.deletions[d] = '\n'.join(ps)
+
+        def _max_dist(self, l):
+                """ Returns the number of typos allowed in a word of <l>
+                    characters """
+                return min(self.max_dist, len([n for n in FUZZY_LENGTHS
+                                                if l >= n]))
+
+        def _similar_words(self, q, k):
+                """ Returns the words within <k> typos of <q> """
+                prefixes = set()
+                for d in _deletions(q[:self.prefix], k,
+                                FUZZY_LENGTHS[0] - self.max_dist):
+                        if d in self.deletions:
+                                prefixes.update(
+                                        self.deletions[d].split('\n'))
+                return [w for p in prefixes for w in self.prefixes[p]
+                                if _distance(q, w, k) <= k]
+
+        def query(self, q, cancel=None):
+                k = self._max_dist(len(q))
+                if k == 0 or ' ' in q:
+                        return self.exact.query(q, cancel)
+                return self._results(q, k, cancel, False)
+
+        def query_entries(self, q, cancel=None):
+                k = self._max_dist(len(q))
+                if k == 0 or ' ' in q:
+                        return self.exact.query_entries(q, cancel)
+                return self._results(q, k, cancel, True)
+
+        def _results(self, q, k, cancel, entries):
+                """ Yields the objs, or if <entries> the entries, of the
+                    exact matches of <q> and then of the entries with a
+                    word within <k> typos of it """
+                dup_lut = set()
+                if entries:
+                        for e in self.exact.query_entries(q, cancel):
+                                dup_lut.add(e[1])
+                                yield e
+                else:
+                        for obj in self.exact.query(q, cancel):
+                                dup_lut.add(obj)
+                                yield obj
+                idxs = set()
+                for w in self._similar_words(q, k):
+                        idxs.update(self.words[w])
+                for i in sorted(idxs):
+                        e = self.sorted_entries[i]
+                        if e[1] in dup_lut:
+                                continue
+                        dup_lut.add(e[1])
+                        yield e if entries else e[1]
+
+        def spans(self, q, txt):
+                ret = self.exact.spans(q, txt)
+                k = self._max_dist(len(q))
+                if k == 0 or ' ' in q:
+                        return ret
+                i = 0
+                for w in txt.split(' '):
+                        if _distance(q, w, k) <= k:
+                                ret.append((i, i + len(w)))
+                        i += len(w) + 1
+                return ret
+
         def prune(self):
-                root = self.cache['']
-                self.cache = dict()
-                self.cache[''] = root
+                self.exact.prune()
+
+        def __getstate__(self):
+                state = dict(self.__dict__)
+                state['words'] = pack_arrays(self.words)
+                # The exact tree has the same entries in the same order
+                del state['sorted_entries']
+                return state
+
+        def __setstate__(self, state):
+                state['words'] = unpack_arrays(state['words'])
+                self.__dict__.update(state)
+                self.sorted_entries = list(self.exact.entries())
+
+        def entries(self):
+                return self.exact.entries()
+
+class MappedLSTree(LSTree):
+        """ Implementation of LSTree on top of a read-only buffer, such as
+            a mmap, containing the texts each followed by SA_SEPARATOR """
+
+        def __init__(self, buf, base, offsets, objs):
+                """ Creates a LS Tree
+                        @buf            Buffer with the texts
+                        @base           Offset of the first text in @buf
+                        @offsets        Sequence with the offset of each
+                                        text relative to @base and one
+                                        extra for the end of the last
+                        @objs           Sequence with the obj of each text
+                """
+                self.buf = buf
+                self.base = base
+                self.offsets = offsets
+                self.objs = objs
+
+        def _indices(self, q, cancel):
+                """ Yields the indices of the texts that contain <q>, but
+                    of the first with each obj only """
+                dup_lut = set()
+                if q == '':
+                        idxs = xrange(len(self.objs))
+                else:
+                        idxs = self._find(q)
+                for n, i in enumerate(idxs):
+                        if n % CANCEL_CHUNK == 0 and not cancel is None \
+                                        and cancel.is_set():
+                                return
+                        obj = self.objs[i]
+                        if obj in dup_lut:
+                                continue
+                        dup_lut.add(obj)
+                        yield i
+
+        def _entry(self, i):
+                return (self.buf[self.base + self.offsets[i]:
+                                 self.base + self.offsets[i+1] - 1],
+                        self.objs[i])
+
+        def query(self, q, cancel=None):
+                return imap(self.objs.__getitem__, self._indices(q, cancel))
+
+        def query_entries(self, q, cancel=None):
+                return imap(self._entry, self._indices(q, cancel))
+
+        def _find(self, q):
+                """ Yields the indices of the texts that contain <q> """
+                end = self.base + self.offsets[len(self.objs)]
+                pos = self.base
+                while True:
+                        pos = self.buf.find(q, pos, end)
+                        if pos == -1:
+                                return
+                        i = bisect_right(self.offsets, pos - self.base) - 1
+                        yield i
+                        # Continue with the next text
+                        pos = self.base + self.offsets[i+1]
+
+        def entries(self):
+                return imap(self._entry, xrange(len(self.objs)))
@@ -4,14 +4,393 @@ import threading
 DEFAULT_HOST = 'marietje.marie-curie.nl'
 DEFAULT_PORT = 1337
 DEFAULT_LS_CHARSET = '1234567890qwertyuiopasdfghjklzxcvbnm '
+DEFAULT_LS_ENGINE = 'simple'
+# Above this fraction of changed songs, the look up tree is rebuilt instead
+# of updated on a refetch
+MAX_SYNC_FRACTION = 0.1
+# Maximum number of idle connections kept open to the daemon
+DEFAULT_POOL_SIZE = 2
+# Initial size of the receive buffer of a connection
+READ_BUFFER_SIZE = 256 * 1024
+# Size of the buffer and of the chunks in which uploads are sent
+UPLOAD_BUFFER_SIZE = 256 * 1024
+# Minimal interval between progress reports while fetching the songs
+PROGRESS_INTERVAL = 0.5
+# Number of results a ResultView pulls in beyond the one asked for
+RESULT_PREFETCH = 256
+# Number of results a RankedResults pulls in at once, to score them after
+# releasing the lock
+RANK_CHUNK = 1024
+# Number of items of a list or dict the worker that builds a look up tree
+# sends at once
+BUILD_CHUNK = 4096
+# Maximum number of seconds between the polls of the playing track by the
+# watcher
+WATCH_INTERVAL = 30.0
+# Seconds around the predicted end of the playing track in which the
+# watcher polls it every WATCH_NEAR_INTERVAL seconds
+WATCH_NEAR = 5.0
+WATCH_NEAR_INTERVAL = 1.0
 
 import os
+import re
+import sys
 import time
+import heapq
+import Queue
+import cPickle
+import multiprocessing
+import select
 import socket
 import logging
-import cPickle as pickle
+import traceback
+import unicodedata
+import songcache
 from cStringIO import StringIO
-from lstree import SimpleCachingLSTree
+from itertools import islice
+from lstree import LSTree, SimpleCachingLSTree, NGramLSTree, \
+                   SuffixArrayLSTree, FuzzyLSTree
+
+LS_ENGINES = {'simple': SimpleCachingLSTree,
+              'ngram': NGramLSTree,
+              'suffix': SuffixArrayLSTree,
+              'fuzzy': FuzzyLSTree}
+
+def entry_compare(x, y):
+        """ Orders live search entries on text and then on id """
+        v = cmp(x[0], y[0])
+        return v if v != 0 else cmp(x[1], y[1])
+
+_non_ascii = re.compile('[\x80-\xff]').search
+
+# Whether look up trees are built in a forked worker process
+BUILD_IN_PROCESS = hasattr(os, 'fork')
+
+class WorkerError(Exception):
+        """ Raised with the traceback of an exception in a worker
+            process """
+        pass
+
+def _is_large(obj):
+        """ Returns whether <obj> takes a while to unpickle """
+        if isinstance(obj, LSTree):
+                return True
+        if isinstance(obj, tuple):
+                return any(map(_is_large, obj))
+        return isinstance(obj, (list, dict)) and len(obj) > BUILD_CHUNK
+
+def _tree_parts(obj):
+        """ Yields the parts in which the worker sends <obj>, which are
+            each quick to unpickle: look up trees and tuples are taken
+            apart, and lists and dicts are sent BUILD_CHUNK items at a
+            time """
+        if isinstance(obj, LSTree):
+                yield ('tree', obj.__class__)
+                state = obj.__getstate__() if hasattr(obj, '__getstate__') \
+                                else obj.__dict__
+                for part in _tree_parts(state):
+                        yield part
+        elif isinstance(obj, tuple) and _is_large(obj):
+                yield ('tuple', len(obj))
+                for v in obj:
+                        for part in _tree_parts(v):
+                                yield part
+        elif isinstance(obj, list) and _is_large(obj):
+                yield ('list',)
+                for i in xrange(0, len(obj), BUILD_CHUNK):
+                        yield ('items', obj[i:i + BUILD_CHUNK])
+                yield ('end',)
+        elif isinstance(obj, dict):
+                yield ('dict',)
+                items = list()
+                for k, v in obj.iteritems():
+                        if _is_large(v):
+                                yield ('item', k)
+                                for part in _tree_parts(v):
+                                        yield part
+                                continue
+                        items.append((k, v))
+                        if len(items) == BUILD_CHUNK:
+                                yield ('items', items)
+                                items = list()
+                yield ('items', items)
+                yield ('end',)
+        else:
+                yield ('value', obj)
+
+def _from_parts(load):
+        """ Returns the object of which <load> returns the parts, as
+            yielded by _tree_parts """
+        part = load()
+        kind = part[0]
+        if kind == 'value':
+                return part[1]
+        if kind == 'tree':
+                cls = part[1]
+                state = _from_parts(load)
+                tree = cls.__new__(cls)
+                if hasattr(tree, '__setstate__'):
+                        tree.__setstate__(state)
+                else:
+                        tree.__dict__.update(state)
+                return tree
+        if kind == 'tuple':
+                return tuple([_from_parts(load) for i in xrange(part[1])])
+        ret = list() if kind == 'list' else dict()
+        while True:
+                part = load()
+                if part[0] == 'end':
+                        return ret
+                if part[0] == 'item':
+                        ret[part[1]] = _from_parts(load)
+                elif kind == 'list':
+                        ret.extend(part[1])
+                else:
+                        ret.update(part[1])
+
+def _build_tree(cls, entries, conn):
+        """ Builds the LSTree <cls> of <entries> and sends it pickled over
+            <conn> in the parts yielded by _tree_parts.  An exception is
+            sent as a ('error', traceback) part.  Runs in the worker
+            process of build_tree. """
+        try:
+                try:
+                        tree = cls(entries, _cmp=entry_compare)
+                        tree.prune()
+                        for part in _tree_parts(tree):
+                                conn.send_bytes(cPickle.dumps(part,
+                                                cPickle.HIGHEST_PROTOCOL))
+                except Exception:
+                        error = cPickle.dumps(('error',
+                                        traceback.format_exc()),
+                                        cPickle.HIGHEST_PROTOCOL)
+                        try:
+                                conn.send_bytes(error)
+                        except (IOError, OSError):
+                                # The parent is gone
+                                pass
+        finally:
+                conn.close()
+
+def build_tree(cls, entries):
+        """ Returns the LSTree <cls> of <entries>.  If BUILD_IN_PROCESS, it
+            is built in a forked process, such that this one stays
+            responsive, and only unpickled here: part by part, such that
+            the other threads get their turns. """
+        if not BUILD_IN_PROCESS:
+                return cls(entries, _cmp=entry_compare)
+        recv_conn, send_conn = multiprocessing.Pipe(False)
+        p = multiprocessing.Process(target=_build_tree,
+                                    args=(cls, entries, send_conn))
+        p.daemon = True
+        p.start()
+        send_conn.close()
+        def load():
+                part = cPickle.loads(recv_conn.recv_bytes())
+                if part[0] == 'error':
+                        raise WorkerError, part[1]
+                return part
+        tree = None
+        try:
+                tree = _from_parts(load)
+        except EOFError:
+                logging.getLogger('Marietje').warning(
+                                "Worker failed to build the look up tree")
+        except WorkerError, e:
+                logging.getLogger('Marietje').warning(
+                                "Worker failed to build the look up tree:\n"
+                                "%s" % e)
+        finally:
+                recv_conn.close()
+                p.join()
+        if tree is None:
+                return cls(entries, _cmp=entry_compare)
+        return tree
+
+class ResultView(object):
+        """ Read-only sequence of the track ids yielded by the iterator
+            <it>, which are only pulled in when they are looked at, plus
+            RESULT_PREFETCH more.  Its length is the number of ids pulled
+            in so far, until <complete> is set.  The ids are pulled in
+            while holding <lock>, which guards what <it> iterates over.
+            Once <valid> returns False, that has changed and no more ids
+            are pulled in. """
+        def __init__(self, it, lock=None, valid=None):
+                self.it = it
+                self.ids = list()
+                self.complete = False
+                self.lock = threading.Lock() if lock is None else lock
+                self.valid = valid
+
+        def fill(self, n, cancel=None):
+                """ Pulls in ids until there are <n>, there are no more or
+                    the threading.Event <cancel> is set """
+                with self.lock:
+                        if not self.complete and not self.valid is None \
+                                        and not self.valid():
+                                self.complete = True
+                                self.it = None
+                        while not self.complete and len(self.ids) < n:
+                                if not cancel is None and cancel.is_set():
+                                        return
+                                try:
+                                        self.ids.append(self.it.next())
+                                except StopIteration:
+                                        self.complete = True
+                                        self.it = None
+
+        def __len__(self):
+                return len(self.ids)
+
+        def __nonzero__(self):
+                self.fill(1)
+                return len(self.ids) != 0
+
+        def __getitem__(self, i):
+                if i < 0:
+                        self.fill(sys.maxint)
+                elif i >= len(self.ids):
+                        self.fill(i + 1 + RESULT_PREFETCH)
+                return self.ids[i]
+
+        def __iter__(self):
+                i = 0
+                while True:
+                        try:
+                                yield self[i]
+                        except IndexError:
+                                return
+                        i += 1
+
+class RankedResults(ResultView):
+        """ ResultView of the track ids of the entries (text, id) yielded
+            by the iterator <it>, ordered on descending score, given by
+            <score> of the text and the id, and then on the order in which
+            they were yielded.  Until it is complete, it ranks the ids
+            pulled in so far.  The entries are pulled in RANK_CHUNK at a
+            time while holding <lock>, and scored after releasing it.  The
+            ids are kept in a heap from which they are only popped when
+            they are looked at, such that the results that are never shown
+            are never sorted. """
+        def __init__(self, it, score, lock=None, valid=None):
+                ResultView.__init__(self, it, lock, valid)
+                self.score = score
+                self.heap = list()
+                self.ranked = list()
+                # Serializes the fills
+                self.fill_lock = threading.Lock()
+                # Guards the heap, ranked and ids
+                self.heap_lock = threading.Lock()
+
+        def fill(self, n, cancel=None):
+                with self.fill_lock:
+                        while not self.complete and len(self.ids) < n:
+                                if not cancel is None and cancel.is_set():
+                                        return
+                                with self.lock:
+                                        if not self.valid is None and \
+                                                        not self.valid():
+                                                chunk = ()
+                                        else:
+                                                chunk = list(islice(self.it,
+                                                                RANK_CHUNK))
+                                seq = len(self.ids)
+                                scored = [(-self.score(txt, id), seq + k, id)
+                                        for k, (txt, id) in enumerate(chunk)]
+                                with self.heap_lock:
+                                        # The ids that were ranked might be
+                                        # outranked by the new ones
+                                        for e in self.ranked:
+                                                heapq.heappush(self.heap, e)
+                                        self.ranked = list()
+                                        for e in scored:
+                                                heapq.heappush(self.heap, e)
+                                        self.ids.extend([id for txt, id
+                                                        in chunk])
+                                        if len(chunk) < RANK_CHUNK:
+                                                self.complete = True
+                                                self.it = None
+
+        def __getitem__(self, i):
+                if i < 0:
+                        self.fill(sys.maxint)
+                        i += len(self.ids)
+                elif i >= len(self.ids):
+                        self.fill(i + 1 + RESULT_PREFETCH)
+                with self.heap_lock:
+                        if i < 0 or i >= len(self.ids):
+                                raise IndexError, i
+                        while len(self.ranked) <= i:
+                                self.ranked.append(heapq.heappop(self.heap))
+                        return self.ranked[i][2]
+
+class MatchSpans(object):
+        """ The spans of the matches of a query in the artist and the title
+            of each of its results, as given by the function <spans> of a
+            track id.  They are computed when they are first looked at. """
+        def __init__(self, spans):
+                self.spans = spans
+                self.cache = dict()
+
+        def __getitem__(self, id):
+                ret = self.cache.get(id)
+                if ret is None:
+                        ret = self.cache[id] = self.spans(id)
+                return ret
+
+class ColumnStats(object):
+        """ The number of rows and the sums and maxima of the lengths of the
+            cells in each of the <ncols> columns of a table, kept up to
+            date as rows are added and removed """
+        def __init__(self, ncols):
+                self.N = 0
+                self.sums = [0] * ncols
+                self.maxs = [0] * ncols
+                # The number of cells of each length, per column, to find
+                # the new maximum when the longest is removed
+                self.counts = [dict() for i in xrange(ncols)]
+
+        def add(self, cells):
+                """ Adds the row <cells> """
+                self.N += 1
+                for j in xrange(len(self.sums)):
+                        l = len(cells[j])
+                        self.sums[j] += l
+                        self.counts[j][l] = self.counts[j].get(l, 0) + 1
+                        if l > self.maxs[j]:
+                                self.maxs[j] = l
+
+        def add_lengths(self, lengths):
+                """ Adds rows, given the lengths of their cells in a
+                    sequence per column """
+                self.N += len(lengths[0])
+                for j in xrange(len(self.sums)):
+                        counts = self.counts[j]
+                        for l in lengths[j]:
+                                counts[l] = counts.get(l, 0) + 1
+                        self.sums[j] += sum(lengths[j])
+                        if counts:
+                                self.maxs[j] = max(counts)
+
+        def remove(self, cells):
+                """ Removes the row <cells>, which has been added """
+                self.N -= 1
+                for j in xrange(len(self.sums)):
+                        l = len(cells[j])
+                        self.sums[j] -= l
+                        counts = self.counts[j]
+                        counts[l] -= 1
+                        if counts[l] == 0:
+                                del counts[l]
+                                if l == self.maxs[j]:
+                                        self.maxs[j] = max(counts) \
+                                                        if counts else 0
+
+        def info(self):
+                """ Returns the number of rows, the average lengths and the
+                    maximum lengths of the columns """
+                N = max(self.N, 1)
+                return (self.N, [x / N for x in self.sums], list(self.maxs))
 
 class MarietjeException(Exception):
         pass
@@ -20,40 +399,185 @@ class AlreadyQueuedException(MarietjeException):
 class AlreadyFetchingException(Exception):
         pass
 
+class ConnectionLostException(MarietjeException):
+        pass
+
+# Parsers for the lines of the replies of the classic protocol
+def parse_queue_header(l):
+        """ Returns (total, timeLeft) """
+        bits = l.split('::')
+        if len(bits) != 4 or \
+           bits[0] != 'TOTAL' or bits[2] != 'TIMELEFT':
+                   raise MarietjeException, "Unexpected reply: %s" % l
+        return (int(bits[1]), float(bits[3]))
+
+def parse_queue_song(l):
+        """ Returns (artist, title, length, requestedBy) """
+        bits = l.split('::')
+        if len(bits) != 5 or bits[0] != 'SONG':
+                raise MarietjeException, "Unexpected SONG line: %s" % l
+        return (bits[1], bits[2], float(bits[3]), bits[4])
+
+def parse_playing(l):
+        """ Returns (id, timeStamp, length, time) """
+        bits = l.split('::')
+        if len(bits) != 8 or bits[0] != 'ID' or bits[2] != 'Timestamp' or \
+                        bits[4] != 'Length' or bits[6] != 'Time':
+                raise MarietjeException, "Unexpected reply: %s" % l
+        return (int(bits[1]), float(bits[3]), float(bits[5]), float(bits[7]))
+
+def parse_list_header(l):
+        """ Returns the number of tracks """
+        bits = l.split('::')
+        if len(bits) != 2 or bits[0] != 'TOTAL':
+                raise MarietjeException, "Unexpected reply: %s" % l
+        return int(bits[1])
+
+def parse_track(l):
+        """ Returns (trackId, artist, title, flag) """
+        bits = l.split('::')
+        if len(bits) != 5 or bits[0] != 'SONG':
+                raise MarietjeException, "Unexpected reply: %s" % l
+        return (int(bits[1]), bits[2], bits[3], int(bits[4]))
+
+def parse_tracks(lines):
+        """ Returns a list of (trackId, artist, title, flag) for the
+            SONG <lines> """
+        fields = '::'.join(lines).split('::')
+        n = len(lines)
+        if len(fields) != 5 * n or fields[0::5].count('SONG') != n:
+                # Find the offending line
+                for l in lines:
+                        parse_track(l)
+        return zip(map(int, fields[1::5]), fields[2::5], fields[3::5],
+                   map(int, fields[4::5]))
+
+def parse_request_reply(l):
+        """ Raises the exception matching the reply to a song request """
+        if l == 'REQUEST::SUCCESS':
+                return
+        if l == 'ERROR::Track already in queue':
+                raise AlreadyQueuedException
+        raise MarietjeException, "Unexpected reply: %s" % l
+
+def upload_request(artist, title, user, size):
+        """ Returns the request to upload a track of <size> bytes as
+            <artist> - <title> by <user>.  Unicode is sent as UTF-8. """
+        fields = [artist, title, user]
+        for i in xrange(len(fields)):
+                if isinstance(fields[i], unicode):
+                        fields[i] = fields[i].encode('utf-8')
+        return 'REQUEST::UPLOAD::ARTIST::%s::TITLE::%s::USER::%s::SIZE::%s' \
+                        % tuple(fields + [size])
+
+class Connection:
+        """ A connection to marietjed, with a buffered reader for the line
+            based replies """
+
+        def __init__(self, s, bufsize=READ_BUFFER_SIZE):
+                self.s = s
+                # The unread data is buf[start:end]
+                self.buf = bytearray(bufsize)
+                self.start = 0
+                self.end = 0
+
+        def send(self, msg):
+                self.s.sendall(msg)
+
+        def _fill(self):
+                """ Receives more data into the buffer """
+                if self.start == self.end:
+                        self.start = self.end = 0
+                elif self.end == len(self.buf):
+                        if self.start == 0:
+                                # A line longer than the buffer
+                                self.buf.extend(bytearray(len(self.buf)))
+                        else:
+                                n = self.end - self.start
+                                self.buf[:n] = self.buf[self.start:self.end]
+                                self.start, self.end = 0, n
+                n = self.s.recv_into(memoryview(self.buf)[self.end:])
+                if n == 0:
+                        raise ConnectionLostException, \
+                                "Connection lost: %s" % \
+                                        str(self.buf[self.start:self.end])
+                self.end += n
+
+        def readline(self):
+                """ Reads a line, without the newline """
+                while True:
+                        idx = self.buf.find('\n', self.start, self.end)
+                        if idx != -1:
+                                break
+                        self._fill()
+                ret = str(self.buf[self.start:idx])
+                self.start = idx + 1
+                return ret
+
+        def read_lines(self, n):
+                """ Reads <n> lines and yields them, without newlines, in
+                    lists of the lines that were received together """
+                while n > 0:
+                        last = self.buf.rfind('\n', self.start, self.end)
+                        if last == -1:
+                                self._fill()
+                                continue
+                        lines = str(self.buf[self.start:last]).split('\n')
+                        if len(lines) > n:
+                                # The buffer holds the start of the next reply
+                                lines = lines[:n]
+                                last = self.start + sum(map(len, lines)) + \
+                                                n - 1
+                        self.start = last + 1
+                        n -= len(lines)
+                        yield lines
+
+        def is_idle(self):
+                """ Whether the daemon didn't close the connection nor sent
+                    anything unexpected since the last reply """
+                if self.start != self.end:
+                        return False
+                try:
+                        r, w, x = select.select([self.s], [], [], 0)
+                except select.error:
+                        return False
+                return len(r) == 0
+
+        def close(self):
+                self.s.close()
+
 class RawMarietje:
         """ Almost direct interface to the Marietje protocol """
 
-        def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                        pool_size=DEFAULT_POOL_SIZE):
+                """ Up to <pool_size> connections are kept open for reuse,
+                    if the daemon allows it. """
                 self.host = host
                 self.port = port
+                self.pool_size = pool_size
+                self.pool = list()
+                self.pool_lock = threading.Lock()
+                # Whether the daemon keeps connections open after a reply:
+                # None if we don't know yet.
+                self.keepalive = None
         
         def check_login(self, username):
                 """ Checks whether <username> is allowed on marietje """
-                return self._simple_transaction("LOGIN::USER::%s\n" % username) \
-                                == "LOGIN::SUCCESS\n"
+                return self._transaction("LOGIN::USER::%s\n" % username,
+                                         lambda c: c.readline()) \
+                                == "LOGIN::SUCCESS"
         
         def get_queue(self):
                 """ Returns ( timeLeft, queue ) where queue is a list of
                     ( artist, title, length, requestedBy ) tuples. """
-                s = self._connect()
-                s.send("LIST::QUEUE\n")
-                f = s.makefile()
-                bits = f.readline()[:-1].split('::')
-                if len(bits) != 4 or \
-                   bits[0] != 'TOTAL' or bits[2] != 'TIMELEFT':
-                           raise MarietjeException, \
-                                "Unexpected reply: %s" % '::'.join(bits)
-                total, timeLeft = int(bits[1]), float(bits[3])
+                return self._transaction("LIST::QUEUE\n", self._read_queue)
+
+        def _read_queue(self, c):
+                total, timeLeft = parse_queue_header(c.readline())
                 rl = list()
-                for i in xrange(total):
-                        bits = f.readline()[:-1].split('::')
-                        if len(bits) != 5 or bits[0] != 'SONG':
-                                raise MarietjeException, \
-                                        "Unexpected SONG line: %s" % '::'.join(bits)
-                        artist, title, length, by = bits[1], bits[2], \
-                                                float(bits[3]), bits[4] 
-                        rl.append((artist, title, length, by))
-                s.close()
+                for lines in c.read_lines(total):
+                        rl.extend(map(parse_queue_song, lines))
                 return (timeLeft, rl)
         
         def get_playing(self):
@@ -61,68 +585,135 @@ class RawMarietje:
                     current playing's song <id> and <length>, the
                     current servers <time> and the starting time <timeStamp>
                     of the song """
-                l = self._simple_transaction("LIST::NOWPLAYING\n")
-                bits = l[:-1].split('::')
-                if len(bits) != 8 or bits[0] != 'ID' or bits[2] != 'Timestamp' or \
-                                bits[4] != 'Length' or bits[6] != 'Time':
-                        raise MarietjeException, "Unexpected reply: %s" % l
-                id, timeStamp, length, time = int(bits[1]), float(bits[3]), \
-                                              float(bits[5]), float(bits[7])
-                return (id, timeStamp, length, time)
-
-        def list_tracks(self):
+                return self._transaction("LIST::NOWPLAYING\n",
+                                         self._read_playing)
+
+        def _read_playing(self, c):
+                return parse_playing(c.readline())
+
+        def get_playing_and_queue(self):
+                """ Returns (playing, queue) as returned by <get_playing>
+                    and <get_queue>.  Both requests are sent before either
+                    reply is read. """
+                if self.keepalive:
+                        c, reused = self._acquire()
+                        try:
+                                c.send("LIST::NOWPLAYING\n")
+                                c.send("LIST::QUEUE\n")
+                                playing = self._read_playing(c)
+                        except (socket.error, ConnectionLostException):
+                                c.close()
+                                if not reused:
+                                        raise
+                                self.keepalive = False
+                                return self.get_playing_and_queue()
+                        except:
+                                c.close()
+                                raise
+                        try:
+                                queue = self._read_queue(c)
+                        except (socket.error, ConnectionLostException):
+                                # The daemon closes after one request,
+                                # after all.
+                                c.close()
+                                self.keepalive = False
+                                return (playing, self.get_queue())
+                        except:
+                                c.close()
+                                raise
+                        self._release(c)
+                        return (playing, queue)
+                cp = Connection(self._connect())
+                try:
+                        cq = Connection(self._connect())
+                except:
+                        cp.close()
+                        raise
+                try:
+                        cp.send("LIST::NOWPLAYING\n")
+                        cq.send("LIST::QUEUE\n")
+                        playing = self._read_playing(cp)
+                        queue = self._read_queue(cq)
+                except:
+                        cp.close()
+                        cq.close()
+                        raise
+                self._release(cp)
+                self._release(cq)
+                return (playing, queue)
+
+        def list_tracks(self, totalCb=None):
                 """ Returns a list of
-                     (trackId, artist, title, flag) """
-                s = self._connect()
-                s.send('LIST::ALL')
-                f = s.makefile()
-                bits = f.readline()[:-1].split('::')
-                if len(bits) != 2 or bits[0] != 'TOTAL':
-                        raise MarietjeException, \
-                                "Unexpected reply: %s" % '::'.join(bits)
-                total = int(bits[1])
-                for i in xrange(total):
-                        bits = f.readline()[:-1].split('::')
-                        if len(bits) != 5 or bits[0] != 'SONG':
-                                raise MarietjeException, \
-                                        "Unexpected reply: %s" % '::'.join(bits)
-                        yield (int(bits[1]), bits[2], bits[3], int(bits[4]))
-                s.close()
+                     (trackId, artist, title, flag).  Calls <totalCb> with
+                     the number of tracks before the first is returned. """
+                for tracks in self.list_track_batches(totalCb):
+                        for track in tracks:
+                                yield track
+
+        def list_track_batches(self, totalCb=None):
+                """ Like <list_tracks>, but yields lists of tracks as they
+                    are received """
+                c, total = self._transaction('LIST::ALL',
+                                self._read_list_header, release=False)
+                try:
+                        if not totalCb is None:
+                                totalCb(total)
+                        for lines in c.read_lines(total):
+                                yield parse_tracks(lines)
+                except:
+                        c.close()
+                        raise
+                self._release(c)
+
+        def _read_list_header(self, c):
+                return (c, parse_list_header(c.readline()))
         
         def request_track(self, trackId, user):
                 """ Requests the song <trackId> under the username <user> """
-                s = self._simple_transaction("REQUEST::SONG::%s::USER::%s" % (
-                        trackId, user))
-                if s == 'REQUEST::SUCCESS':
-                        return
-                if s == 'ERROR::Track already in queue':
-                        raise AlreadyQueuedException
-                raise MarietjeException, "Unexpected reply: %s" % s
+                parse_request_reply(self._simple_transaction(
+                        "REQUEST::SONG::%s::USER::%s" % (trackId, user)))
 
-        def upload_track(self, artist, title, user, size, f):
+        def upload_track(self, artist, title, user, size, f, progressCb=None):
                 """ Uploads <size> bytes of <f> as the track 
-                    <artist> - <title> as <user> """
+                    <artist> - <title> as <user>.  Calls <progressCb> with
+                    the number of bytes sent so far and <size>. """
                 s = self._connect()
-                s.send('REQUEST::UPLOAD::ARTIST::%s::TITLE::%s::USER::%s::SIZE::%s' % (
-                        artist, title, user, size))
-                l = s.recv(50)
-                if l != 'SEND::FILE':
-                        raise MarietjeException, \
-                                "Unexpected reply: %s" % l
+                try:
+                        s.send(upload_request(artist, title, user, size))
+                        l = s.recv(50)
+                        if l != 'SEND::FILE':
+                                raise MarietjeException, \
+                                        "Unexpected reply: %s" % l
+                        self._send_buffered(s, size, f, progressCb)
+                        l = s.recv(50)
+                        if l != 'UPLOAD::SUCCESS':
+                                raise MarietjeException, \
+                                        "Unexpected reply: %s" % l
+                finally:
+                        s.close()
+
+        def _send_buffered(self, s, size, f, progressCb):
+                """ Sends <size> bytes of <f> to <s> through a buffer """
+                buf = bytearray(min(size, UPLOAD_BUFFER_SIZE))
+                view = memoryview(buf)
                 sent = 0
                 while sent != size:
-                        toSent = size - sent
-                        if toSent > 2048: toSent = 2048
-                        stillToSent = toSent
-                        txt = f.read(stillToSent)
-                        while stillToSent > 0:
-                                stillToSent -= s.send(txt[-stillToSent:])       
-                        sent += toSent
-                l = s.recv(50)
-                if l != 'UPLOAD::SUCCESS':
-                        raise MarietjeException, \
-                                "Unexpected reply: %s" % l
-                s.close()
+                        toSend = min(size - sent, len(buf))
+                        if hasattr(f, 'readinto'):
+                                n = f.readinto(view[:toSend])
+                        else:
+                                data = f.read(toSend)
+                                n = len(data)
+                                buf[:n] = data
+                        if n == 0:
+                                raise MarietjeException, \
+                                        "File is shorter than size"
+                        offset = 0
+                        while offset != n:
+                                offset += s.send(view[offset:n])
+                        sent += n
+                        if not progressCb is None:
+                                progressCb(sent, size)
 
         def _connect(self):
                 s = socket.socket(socket.AF_INET,
@@ -130,6 +721,63 @@ class RawMarietje:
                 s.connect((self.host, self.port))
                 return s
 
+        def _acquire(self):
+                """ Returns (connection, reused): a pooled connection if
+                    there is a usable one and otherwise a new one """
+                with self.pool_lock:
+                        while self.pool:
+                                c = self.pool.pop()
+                                if c.is_idle():
+                                        return (c, True)
+                                c.close()
+                                self.keepalive = False
+                return (Connection(self._connect()), False)
+
+        def _release(self, c):
+                """ Returns the connection <c>, of which the last reply has
+                    been read completely, to the pool if it's still open """
+                if self.keepalive is False or not c.is_idle():
+                        if self.keepalive is None:
+                                self.keepalive = False
+                        c.close()
+                        return
+                with self.pool_lock:
+                        if len(self.pool) < self.pool_size:
+                                self.pool.append(c)
+                                return
+                c.close()
+
+        def _transaction(self, msg, read, release=True):
+                """ Sends <msg> and returns read(connection).  If the
+                    daemon closed a reused connection, it is retried on a
+                    new one.  If not <release>, the caller should release
+                    the connection. """
+                c, reused = self._acquire()
+                try:
+                        c.send(msg)
+                        ret = read(c)
+                except (socket.error, ConnectionLostException):
+                        c.close()
+                        if not reused:
+                                raise
+                        self.keepalive = False
+                        return self._transaction(msg, read, release)
+                except:
+                        c.close()
+                        raise
+                if reused:
+                        self.keepalive = True
+                if release:
+                        self._release(c)
+                return ret
+
+        def close(self):
+                """ Closes the pooled connections """
+                with self.pool_lock:
+                        pool, self.pool = self.pool, list()
+                for c in pool:
+                        c.close()
+
         def _simple_transaction(self, msg):
                 s = self._connect()
                 s.send(msg)
@@ -147,15 +795,29 @@ class Marietje:
                   this class is not to be used by several threads at a time """
         def __init__(self, username, queueCb=None, songCb=None, playingCb=None,
                         host=DEFAULT_HOST, port=DEFAULT_PORT,
-                        charset=DEFAULT_LS_CHARSET):
+                        charset=DEFAULT_LS_CHARSET, engine=DEFAULT_LS_ENGINE,
+                        songProgressCb=None, fold=True):
                 """ <xCb> is a callback for when x is fetched;
+                    <songProgressCb> is called with the number of fetched
+                    and the total number of songs while fetching them;
                     <charset> is used as charset for the livesearch look-up
-                    tree. """
+                    tree;  <engine> is the name of the LSTree implementation
+                    in LS_ENGINES used for it.  If <fold>, accents are
+                    stripped from non-ASCII texts before they are
+                    sanitized, such that they are found by ASCII
+                    queries. """
                 self.raw = RawMarietje(host, port)
                 self.queueCb = queueCb
                 self.songCb = songCb
+                self.songProgressCb = songProgressCb
                 self.playingCb = playingCb
                 self.songs_fetched = False
+                self.songs_partial = False
+                # The number of times sLut was updated in place, after
+                # which lazy results of it are stale
+                self.sLut_updates = 0
+                # The ColumnStats of the artists and titles of the songs
+                self.songs_stats = None
                 self.queue_fetched = False
                 self.playing_fetched = False
                 self.songs_fetching = False
@@ -166,18 +828,118 @@ class Marietje:
                 self.playing_cond = threading.Condition()
                 self.cs = charset
                 self.cs_lut = set(charset)
+                # str.translate deletes the characters not in the charset
+                # and then lowercases the rest
+                self.cs_table = ''.join([chr(i).lower() for i in xrange(256)])
+                self.cs_delete = ''.join([chr(i) for i in xrange(256)
+                                if not chr(i).lower() in self.cs_lut])
+                self.cs_delete_lines = self.cs_delete.replace('\n', '')
+                self.fold = fold
+                if not engine in LS_ENGINES:
+                        raise ValueError, "Unknown search engine: %s" % engine
+                self.lsTreeClass = LS_ENGINES[engine]
+                # The words of the last query, to warm new look up trees
+                self.last_terms = ()
                 self.username = username
                 self.l = logging.getLogger('Marietje')
+                # The watcher sleeps in a select on watch_pipe, which is
+                # written to wake it up; these are guarded by playing_cond
+                self.watch_thread = None
+                self.watch_pipe = None
+                self.watch_woken = False
+                self.watch_requested = False
         
         def _sanitize(self, txt):
                 """ Prepares a str <txt> for live search """
-                txt = txt.lower()
-                ret = ''
-                for c in txt:
-                        if c in self.cs_lut:
-                                ret += c
-                return ret
+                if isinstance(txt, unicode) or (self.fold and
+                                                _non_ascii(txt)):
+                        txt = self._fold(txt)
+                return txt.translate(self.cs_table, self.cs_delete)
+
+        def _fold(self, txt):
+                """ Strips the accents of the str or unicode <txt>.  A str
+                    is assumed to be UTF-8, or Latin-1 if it isn't. """
+                if not isinstance(txt, unicode):
+                        try:
+                                txt = txt.decode('utf-8')
+                        except UnicodeDecodeError:
+                                txt = txt.decode('latin-1')
+                return unicodedata.normalize('NFKD', txt).encode('ascii',
+                                                                 'ignore')
         
+        def _sanitize_offsets(self, txt):
+                """ Returns <txt> sanitized, and the offsets in <txt> of the
+                    start and of the end of the character each of its
+                    characters stems from """
+                chars = txt
+                encoding = None
+                if not isinstance(txt, unicode) and self.fold and \
+                                _non_ascii(txt):
+                        try:
+                                chars = txt.decode('utf-8')
+                                encoding = 'utf-8'
+                        except UnicodeDecodeError:
+                                chars = txt.decode('latin-1')
+                                encoding = 'latin-1'
+                ret = list()
+                starts = list()
+                ends = list()
+                offset = 0
+                for c in chars:
+                        end = offset + (1 if encoding is None else
+                                        len(c.encode(encoding)))
+                        c = self._sanitize(c)
+                        ret.append(c)
+                        starts.extend([offset] * len(c))
+                        ends.extend([end] * len(c))
+                        offset = end
+                return ''.join(ret), starts, ends
+
+        def _cell_spans(self, spans, txt, start, end):
+                """ Returns the merged spans in <txt> of the <spans> in the
+                    part from <start> to <end> of the entry text with it,
+                    where <txt> is given by _sanitize_offsets """
+                txt, starts, ends = txt
+                ret = list()
+                for s, e in spans:
+                        s = max(s, start) - start
+                        e = min(e, end) - start
+                        if s >= e:
+                                continue
+                        s, e = starts[s], ends[e - 1]
+                        if ret and s <= ret[-1][1]:
+                                ret[-1] = (ret[-1][0], max(e, ret[-1][1]))
+                        else:
+                                ret.append((s, e))
+                return ret
+
+        def match_spans(self, q):
+                """ Returns the MatchSpans of the query <q>: the matches of
+                    each of its words, also those found by the fuzzy
+                    search, in the artists and titles.  The songs might be
+                    replaced before the query is performed: the songs that
+                    weren't there yet have no spans. """
+                terms = set(self._sanitize(q).split())
+                with self.songs_cond:
+                        songs, sLut = self.songs, self.sLut
+                def spans(id):
+                        song = songs.get(id)
+                        if song is None:
+                                return ([], [])
+                        artist, title = song
+                        artist = self._sanitize_offsets(artist)
+                        title = self._sanitize_offsets(title)
+                        txt = artist[0] + ' ' + title[0]
+                        ret = list()
+                        for t in terms:
+                                ret.extend(sLut.spans(t, txt))
+                        ret.sort()
+                        n = len(artist[0])
+                        return (self._cell_spans(ret, artist, 0, n),
+                                self._cell_spans(ret, title, n + 1,
+                                                 len(txt)))
+                return MatchSpans(spans)
+
         def _request_song_fetch(self):
                 with self.songs_cond:
                         if self.songs_fetching:
@@ -213,8 +975,10 @@ class Marietje:
                 except AlreadyFetchingException:
                         fetchQueue = False
                 if fetchSongs: self.start_fetch_songs()
-                if fetchQueue: self.start_fetch_queue()
-                if fetchPlaying: self.start_fetch_playing()
+                if fetchQueue and fetchPlaying:
+                        self.start_fetch_playing_and_queue()
+                elif fetchQueue: self.start_fetch_queue()
+                elif fetchPlaying: self.start_fetch_playing()
 
         # These will be used if the annoying marietjed bug is fixed
         def start_fetch_songs(self):
@@ -226,30 +990,203 @@ class Marietje:
         def start_fetch_playing(self):
                 self.playing_thread = threading.Thread(target=self.run_fetch_playing)
                 self.playing_thread.start()
+        def start_fetch_playing_and_queue(self):
+                self.playing_thread = threading.Thread(
+                                target=self.run_fetch_playing_and_queue)
+                self.queue_thread = self.playing_thread
+                self.playing_thread.start()
         
-        def run_fetch_songs(self):
-                def entry_compare(x, y):
-                        v = cmp(x[0], y[0])
-                        return v if v != 0 else cmp(x[1], y[1])
+        def _song_entry(self, id, song):
+                """ Returns the live search entry for <song> with <id> """
+                artist, title = song
+                return (self._sanitize(artist) + " " + self._sanitize(title), id)
+
+        def _song_entries(self, songs):
+                """ Returns the live search entries for the (id, song) pairs
+                    in <songs>.  The texts are sanitized at once: artists
+                    and titles never contain a newline. """
+                fields = list()
+                for id, (artist, title) in songs:
+                        fields.append(artist)
+                        fields.append(title)
+                txt = '\n'.join(fields)
+                if isinstance(txt, unicode) or (self.fold and
+                                                _non_ascii(txt)):
+                        txt = '\n'.join([self._fold(f) if
+                                        isinstance(f, unicode) or
+                                        _non_ascii(f) else f
+                                        for f in fields])
+                fields = txt.translate(self.cs_table,
+                                self.cs_delete_lines).split('\n')
+                return [(fields[2*i] + " " + fields[2*i+1], id)
+                                for i, (id, song) in enumerate(songs)]
+
+        def _songs_stats(self, songs):
+                """ Returns the ColumnStats of the artists and titles of
+                    the Catalog <songs> """
+                stats = ColumnStats(2)
+                stats.add_lengths(songs.lengths())
+                return stats
+
+        def _diff_songs(self, old, new):
+                """ Returns the entries to add and to remove to get from the
+                    songs <old> to <new> """
+                removed, added = songcache.diff(old, new)
+                return (self._song_entries([(id, new[id]) for id in added]),
+                        self._song_entries([(id, old[id])
+                                                for id in removed]))
+
+        def _publish_partial(self, songs, sLut, added):
+                """ Makes the songs fetched so far searchable: publishes
+                    with <songs> a new partial look up tree with the
+                    entries of <sLut>, if not None, and <added>.  Returns
+                    the tree, or None if the songs were fetched otherwise
+                    meanwhile. """
+                # The new tree is built outside the lock, while the
+                # published one is being queried.  Only the new entries
+                # are sorted: the sort of the tree merges the two runs.
+                added = sorted(added, cmp=entry_compare)
+                if sLut is None:
+                        root = added
+                else:
+                        root = list(sLut.entries())
+                        root.extend(added)
+                sLut = SimpleCachingLSTree(root, _cmp=entry_compare)
+                with self.songs_cond:
+                        if self.songs_fetched and not self.songs_partial:
+                                # e.g. the cache was loaded meanwhile
+                                return None
+                        self.songs = songs
+                        self.songs_stats = None
+                        self.sLut = sLut
+                        self.songs_partial = True
+                        self.songs_fetched = True
+                        return sLut
+
+        def _stream_songs(self, publish):
+                """ Fetches the songs, while a second thread creates their
+                    look up entries.  If <publish>, the songs fetched so far
+                    are made searchable every PROGRESS_INTERVAL.  Returns
+                    (songs, entries) """
+                songs = dict()
+                entries = list()
+                chunks = Queue.Queue()
+                state = {'total': None, 'error': None, 'publish': publish}
+                def set_total(total):
+                        state['total'] = total
+                def consume():
+                        partial = None
+                        pending = list()
+                        last = time.time()
+                        while True:
+                                chunk = chunks.get()
+                                if chunk is None:
+                                        break
+                                new = self._song_entries(chunk)
+                                entries.extend(new)
+                                pending.extend(new)
+                                if time.time() - last < PROGRESS_INTERVAL:
+                                        continue
+                                last = time.time()
+                                if state['publish']:
+                                        partial = self._publish_partial(
+                                                        songs, partial,
+                                                        pending)
+                                        state['publish'] = \
+                                                        not partial is None
+                                pending = list()
+                                if not self.songProgressCb is None:
+                                        self.songProgressCb(len(entries),
+                                                        state['total'])
+                def run_consume():
+                        try:
+                                consume()
+                        except Exception, e:
+                                state['error'] = e
+                                # Keep draining, so the producer finishes
+                                while not chunks.get() is None:
+                                        pass
+                consumer = threading.Thread(target=run_consume)
+                consumer.start()
+                try:
+                        for tracks in self.raw.list_track_batches(
+                                        totalCb=set_total):
+                                chunk = [(id, (artist, title))
+                                        for id, artist, title, flag in tracks]
+                                songs.update(chunk)
+                                chunks.put(chunk)
+                finally:
+                        chunks.put(None)
+                        consumer.join()
+                if not state['error'] is None:
+                        raise state['error']
+                return songs, entries
+
+        def run_fetch_songs(self, sync=True):
+                """ Fetches the songs.  If <sync> and the songs were fetched
+                    before, only the changes are applied to the current
+                    look up tree, if it supports it.  Otherwise the look
+                    up entries are created while the songs are fetched. """
                 try:
                         starttime = time.time()
-                        songs = dict()
-                        for id, artist, title, flag in self.raw.list_tracks():
-                                songs[id] = (artist, title)
+                        old_songs = old_sLut = None
+                        with self.songs_cond:
+                                if self.songs_fetched and \
+                                                not self.songs_partial:
+                                        old_songs = self.songs
+                                        old_sLut = self.sLut
+                        sync = sync and not old_songs is None and \
+                                        isinstance(old_sLut, self.lsTreeClass)
+                        if sync:
+                                songs = dict()
+                                for tracks in self.raw.list_track_batches():
+                                        songs.update([(id, (artist, title))
+                                                for id, artist, title, flag
+                                                in tracks])
+                                entries = None
+                        else:
+                                songs, entries = self._stream_songs(
+                                                publish=old_songs is None)
                         sLoadTime = time.time() - starttime
                         starttime = time.time()
-                        entries = list()
-                        for id, (artist, title) in songs.iteritems():
-                                entries.append((self._sanitize(artist) + " " +
-                                        self._sanitize(title), id))
-                        sLut = SimpleCachingLSTree(entries, _cmp=entry_compare)
+                        changes = None
+                        songs = songcache.catalog(songs)
+                        songs_stats = self._songs_stats(songs)
+                        if sync:
+                                added, removed = self._diff_songs(old_songs,
+                                                                  songs)
+                                if len(added) + len(removed) <= \
+                                                MAX_SYNC_FRACTION * len(songs):
+                                        changes = (added, removed)
+                        if not changes is None:
+                                with self.songs_cond:
+                                        try:
+                                                old_sLut.update(*changes)
+                                                self.sLut_updates += 1
+                                                self.songs = songs
+                                                self.songs_stats = songs_stats
+                                        except NotImplementedError:
+                                                changes = None
+                        if changes is None:
+                                if entries is None:
+                                        entries = self._song_entries(
+                                                        songs.items())
+                                sLut = build_tree(self.lsTreeClass, entries)
+                                self._warm(sLut)
+                        else:
+                                self.l.info("Synced %s new and %s removed "
+                                        "entries" % tuple(map(len, changes)))
+                                sLut = old_sLut
+                                self._warm(sLut)
                         sLutGenTime = time.time() - starttime
                         with self.songs_cond:
                                 self.songs = songs
+                                self.songs_stats = songs_stats
                                 self.sLoadTime = sLoadTime
                                 self.sLutGenTime = sLutGenTime
                                 self.sLut = sLut
                                 self.songs_fetched = True
+                                self.songs_partial = False
                 except MarietjeException, e:
                         self.sException = e
                         self.l.exception("Marietje exception")
@@ -257,108 +1194,401 @@ class Marietje:
                         self.l.exception("Uncaught exception")
                 finally:
                         with self.songs_cond:
+                                if self.songs_partial:
+                                        # The fetch failed halfway
+                                        self.songs_partial = False
+                                        self.songs_fetched = False
                                 self.songs_fetching = False
                                 self.songs_cond.notifyAll()
                         if not self.songCb is None:
                                 self.songCb()
         
+        def _set_queue(self, queue_totalTime, queue, qLoadTime):
+                with self.queue_cond:
+                        self.queue_totalTime = queue_totalTime
+                        self.queue = queue
+                        self.qLoadTime = qLoadTime
+                        self.queue_fetched = True
+
+        def _queue_fetch_done(self):
+                with self.queue_cond:
+                        self.queue_fetching = False
+                        self.queue_cond.notifyAll()
+                if not self.queueCb is None:
+                        self.queueCb()
+
+        def _set_playing(self, nowPlaying, starttime, pLoadTime):
+                playingRetreivedTime = starttime + 0.5 * pLoadTime
+                queueOffsetTime = nowPlaying[1] - (nowPlaying[3] - 
+                                  playingRetreivedTime) + nowPlaying[2]
+                with self.playing_cond:
+                        self.nowPlaying = nowPlaying
+                        self.pLoadTime = pLoadTime
+                        self.playingRetreivedTime = playingRetreivedTime
+                        self.queueOffsetTime = queueOffsetTime
+                        self.playing_fetched = True
+
+        def _playing_fetch_done(self):
+                with self.playing_cond:
+                        self.playing_fetching = False
+                        self.playing_cond.notifyAll()
+                # Let the watcher reconsider its interval
+                self._wake_watch()
+                if not self.playingCb is None:
+                        self.playingCb()
+
         def run_fetch_queue(self):
                 try:
                         starttime = time.time()
                         queue_totalTime, queue = self.raw.get_queue()
-                        qLoadTime = time.time() - starttime
-                        with self.queue_cond:
-                                self.queue_totalTime = queue_totalTime
-                                self.queue = queue
-                                self.qLoadTime = qLoadTime
-                                self.queue_fetched = True
+                        self._set_queue(queue_totalTime, queue,
+                                        time.time() - starttime)
                 except MarietjeException, e:
                         self.qException = e
                         self.l.exception("Marietje exception")
                 except Exception:
                         self.l.exception("Uncaught exception")
                 finally:
-                        with self.queue_cond:
-                                self.queue_fetching = False
-                                self.queue_cond.notifyAll()
-                        if not self.queueCb is None:
-                                self.queueCb()
+                        self._queue_fetch_done()
 
         def run_fetch_playing(self):
                 try:
                         starttime = time.time()
                         nowPlaying = self.raw.get_playing()
-                        pLoadTime = time.time() - starttime
-                        playingRetreivedTime = starttime + 0.5 * pLoadTime
-                        queueOffsetTime = nowPlaying[1] - (nowPlaying[3] - 
-                                          playingRetreivedTime) + nowPlaying[2]
-                        with self.playing_cond:
-                                self.nowPlaying = nowPlaying
-                                self.pLoadTime = pLoadTime
-                                self.playingRetreivedTime = playingRetreivedTime
-                                self.queueOffsetTime = queueOffsetTime
-                                self.playing_fetched = True
+                        self._set_playing(nowPlaying, starttime,
+                                          time.time() - starttime)
                 except MarietjeException, e:
                         self.pException = e
                         self.l.exception("Marietje exception")
                 except Exception:
                         self.l.exception("Uncaught exception")
                 finally:
-                        with self.playing_cond:
-                                self.playing_fetching = False
-                                self.playing_cond.notifyAll()
-                        if not self.playingCb is None:
-                                self.playingCb()
+                        self._playing_fetch_done()
+
+        def run_fetch_playing_and_queue(self):
+                try:
+                        starttime = time.time()
+                        nowPlaying, (queue_totalTime, queue) = \
+                                        self.raw.get_playing_and_queue()
+                        loadTime = time.time() - starttime
+                        self._set_playing(nowPlaying, starttime, loadTime)
+                        self._set_queue(queue_totalTime, queue, loadTime)
+                except MarietjeException, e:
+                        self.pException = e
+                        self.qException = e
+                        self.l.exception("Marietje exception")
+                except Exception:
+                        self.l.exception("Uncaught exception")
+                finally:
+                        self._playing_fetch_done()
+                        self._queue_fetch_done()
         
         def cache_songs_to(self, f):
                 """ Caches the songs and its look up structures to the given
                     file """
                 with self.songs_cond:
-                        if not self.songs_fetched:
+                        if not self.songs_fetched or self.songs_partial:
                                 raise RuntimeError, "songs haven't been fetched"
                         songs = self.songs
                         sLut = self.sLut
                 
                 sLut.prune()    
-                pickle.dump((songs, sLut), f, pickle.HIGHEST_PROTOCOL)
+                songcache.write(f, songs, sLut)
         
-        def songs_from_cache(self, f, abort_on_preempt=True):
+        def songs_from_cache(self, f, abort_on_preempt=True, rebuild=True):
                 """ Fetches songs and its look up structure from a cache in
                     file created by <cache_songs_to>. Calls the callback
                     If after having loaded the cache, <songs_fetched> is set,
-                    it'll abort if <abort_on_preempt>. """
+                    it'll abort if <abort_on_preempt>.  The cache is mapped
+                    into memory and read lazily; <f> may be closed
+                    afterwards, but the file should not be overwritten in
+                    place.  The cache is searched with a MappedLSTree; if
+                    <rebuild>, the configured look up tree is built from it
+                    in the background and takes its place. """
                 starttime = time.time()
-                songs, sLut = pickle.load(f)
+                songs, sLut = songcache.read(f)
+                songs_stats = self._songs_stats(songs)
                 sLoadTime = time.time() - starttime
                 with self.songs_cond:
-                        if abort_on_preempt and self.songs_fetched:
+                        if abort_on_preempt and self.songs_fetched and \
+                                        not self.songs_partial:
                                 return
+                        self.songs_partial = False
                         self.songs = songs
+                        self.songs_stats = songs_stats
                         self.sLut = sLut
                         self.songs_fetched = True
                         self.sCacheLoadTime = sLoadTime
                 if not self.songCb is None:
                         self.songCb(from_cache=True)
+                if rebuild:
+                        self.rebuild_thread = threading.Thread(
+                                        target=self.run_rebuild_tree,
+                                        args=(sLut,))
+                        self.rebuild_thread.daemon = True
+                        self.rebuild_thread.start()
+
+        def run_rebuild_tree(self, old_sLut):
+                """ Builds the configured look up tree of the entries of
+                    <old_sLut> and uses it instead, unless the songs were
+                    fetched meanwhile """
+                try:
+                        starttime = time.time()
+                        sLut = build_tree(self.lsTreeClass,
+                                          list(old_sLut.entries()))
+                        self._warm(sLut)
+                        with self.songs_cond:
+                                if not self.sLut is old_sLut:
+                                        return
+                                self.sLut = sLut
+                        self.l.info("Rebuilt the look up tree of the cache "
+                                    "in %s" % (time.time() - starttime))
+                except Exception:
+                        self.l.exception("Uncaught exception")
         
-        def query(self, q):
-                """ Performs a query for all songs that have <q> in their title
-                    or artist.  Returns a list of ids """
+        def query(self, q, rank=False, cancel=None, lazy=False):
+                """ Performs a query for all songs that have every word of
+                    <q> in their artist or title, in any order.  Returns a
+                    list of ids, ordered as the songs, or if <rank>, a
+                    RankedResults ordered on how well they match.  If the
+                    threading.Event <cancel> is set meanwhile, the query
+                    is aborted and None is returned.  If <lazy>, the
+                    results of a single word and the ranked results are
+                    returned as a ResultView, of which only the first
+                    RESULT_PREFETCH are looked up yet. """
                 q = self._sanitize(q)
-                # bit of a performance waster, but we don't want one track
-                # several times in the results (when artist and title match)
+                terms = sorted(set(q.split()))
                 start = time.time()
-                ret = tuple(self.sLut.query(q))
+                with self.songs_cond:
+                        self.last_terms = terms
+                        updates = self.sLut_updates
+                        valid = lambda: self.sLut_updates == updates
+                        if rank and len(terms) == 1:
+                                ret = RankedResults(self.sLut.query_entries(
+                                                terms[0], cancel),
+                                        self._scorer(terms),
+                                        self.songs_cond, valid)
+                        elif rank and terms:
+                                ret = RankedResults(iter(self._query_terms(
+                                                terms, cancel, True)),
+                                        self._scorer(terms))
+                        elif len(terms) <= 1 and lazy:
+                                ret = ResultView(self.sLut.query(
+                                                terms[0] if terms else '',
+                                                cancel), self.songs_cond,
+                                        valid)
+                                ret.fill(RESULT_PREFETCH, cancel)
+                        elif len(terms) <= 1:
+                                ret = tuple(self.sLut.query(
+                                                terms[0] if terms else '',
+                                                cancel))
+                        else:
+                                ret = self._query_terms(terms, cancel)
+                # The ranked results are scored outside the lock
+                if isinstance(ret, RankedResults):
+                        ret.fill(RESULT_PREFETCH if lazy else sys.maxint,
+                                 cancel)
+                if not cancel is None and cancel.is_set():
+                        self.l.info('query %s cancelled' % q)
+                        return None
                 self.l.info('query %s took %s' % (q, time.time() - start))
                 return ret
 
+        def _scorer(self, terms):
+                """ Returns the function that scores a song, given the text
+                    and the id of its live search entry, on how well it
+                    matches the <terms>.  A term at the start of the text,
+                    which is that of the artist, weighs most, then a term
+                    at the start of a word, the less the further the word
+                    is in the text, and then a term inside a word.  Newer
+                    songs, with a higher id, are preferred slightly. """
+                def score(txt, id):
+                        ret = id / 2147483648.0
+                        for t in terms:
+                                if txt.startswith(t):
+                                        ret += 6
+                                        continue
+                                j = txt.find(' ' + t)
+                                if j == -1:
+                                        ret += 1
+                                else:
+                                        ret += 6 - min(3, txt.count(' ', 0,
+                                                                    j + 1))
+                        return ret
+                return score
+
+        def _warm(self, sLut):
+                """ Performs the last query, and the queries typed before it,
+                    on the new look up tree <sLut>, to fill its caches.
+                    <sLut> might be in use: each query holds songs_cond, as
+                    the queries of the user do. """
+                for t in self.last_terms:
+                        for j in xrange(1, len(t) + 1):
+                                with self.songs_cond:
+                                        for id in sLut.query(t[:j]):
+                                                pass
+
+        def _query_terms(self, terms, cancel=None, entries=False):
+                """ Returns the ids, or if <entries> the live search entries
+                    (text, id), of the songs that match all <terms>, by
+                    intersecting the results of the terms, starting with
+                    the one with the fewest """
+                query = self.sLut.query_entries if entries else \
+                                self.sLut.query
+                results = list()
+                for t in terms:
+                        if not cancel is None and cancel.is_set():
+                                return ()
+                        results.append(tuple(query(t, cancel)))
+                results.sort(key=len)
+                ret = results[0]
+                for r in results[1:]:
+                        if not ret:
+                                break
+                        if entries:
+                                lut = set([id for txt, id in r])
+                                ret = tuple([e for e in ret if e[1] in lut])
+                        else:
+                                lut = set(r)
+                                ret = tuple([id for id in ret if id in lut])
+                return ret
+
         def request_track(self, track_id):
                 """ Requests the track with id <track_id> """
                 self.raw.request_track(track_id, self.username)
+                with self.playing_cond:
+                        self.watch_requested = True
+                self._wake_watch()
+
+        def start_watch(self):
+                """ Starts watching the playing track in the background,
+                    to fetch it and the queue again when it changed or a
+                    track was requested.  The callbacks are called as with
+                    start_fetch. """
+                if not self.watch_thread is None:
+                        return
+                pipe = os.pipe()
+                with self.playing_cond:
+                        self.watch_pipe = pipe
+                        self.watch_woken = False
+                self.watch_thread = threading.Thread(target=self.run_watch,
+                                                     args=(pipe,))
+                self.watch_thread.daemon = True
+                self.watch_thread.start()
+
+        def stop_watch(self):
+                """ Stops watching the playing track.  Does not wait for
+                    the watcher, which may be stuck talking to marietje: it
+                    stores nothing more and exits when it wakes up. """
+                if self.watch_thread is None:
+                        return
+                self._wake_watch()
+                with self.playing_cond:
+                        self.watch_pipe = None
+                self.watch_thread = None
+
+        def _watching(self, pipe):
+                """ Returns whether the watcher of <pipe> should go on """
+                with self.playing_cond:
+                        return self.watch_pipe is pipe
+
+        def _wake_watch(self):
+                """ Wakes up the watcher, if any """
+                with self.playing_cond:
+                        # One pending byte suffices; more could fill the pipe
+                        if self.watch_pipe is None or self.watch_woken:
+                                return
+                        self.watch_woken = True
+                        os.write(self.watch_pipe[1], 'w')
+
+        def _watch_interval(self):
+                """ Returns the number of seconds until the playing track
+                    should be polled: often around its predicted end,
+                    rarely otherwise """
+                with self.playing_cond:
+                        if not self.playing_fetched:
+                                return WATCH_INTERVAL
+                        left = self.queueOffsetTime - time.time()
+                if left > WATCH_NEAR:
+                        return min(left - WATCH_NEAR, WATCH_INTERVAL)
+                if left > -WATCH_NEAR:
+                        return WATCH_NEAR_INTERVAL
+                return WATCH_INTERVAL
+
+        def run_watch(self, pipe):
+                try:
+                        self._run_watch(pipe)
+                finally:
+                        os.close(pipe[0])
+                        os.close(pipe[1])
+
+        def _run_watch(self, pipe):
+                deadline = time.time() + self._watch_interval()
+                while True:
+                        try:
+                                r, w, x = select.select([pipe[0]], [], [],
+                                        max(0, deadline - time.time()))
+                        except select.error:
+                                # Interrupted by a signal
+                                continue
+                        with self.playing_cond:
+                                if not self.watch_pipe is pipe:
+                                        return
+                                if r:
+                                        os.read(pipe[0], 1)
+                                        self.watch_woken = False
+                                requested = self.watch_requested
+                                self.watch_requested = False
+                        now = time.time()
+                        if not requested and now < deadline:
+                                # Woken up to reconsider the interval
+                                deadline = min(deadline,
+                                                now + self._watch_interval())
+                                continue
+                        try:
+                                self._watch_poll(pipe, requested)
+                        except MarietjeException, e:
+                                self.l.info("Watch poll failed: %s" % e)
+                        except Exception:
+                                self.l.exception("Uncaught exception")
+                        deadline = time.time() + self._watch_interval()
+
+        def _watch_poll(self, pipe, requested):
+                """ Fetches the playing track and, if it changed or
+                    <requested>, the queue.  An unchanged playing track is
+                    not stored, for its predicted end would only jitter. """
+                starttime = time.time()
+                nowPlaying = self.raw.get_playing()
+                pLoadTime = time.time() - starttime
+                with self.playing_cond:
+                        changed = not self.playing_fetched or \
+                                        self.nowPlaying[0] != nowPlaying[0]
+                if not changed and not requested:
+                        return
+                if not self._watching(pipe):
+                        return
+                try:
+                        self._request_playing_fetch()
+                except AlreadyFetchingException:
+                        # It is being fetched anyway
+                        return
+                try:
+                        self._set_playing(nowPlaying, starttime, pLoadTime)
+                finally:
+                        self._playing_fetch_done()
+                if not self._watching(pipe):
+                        return
+                try:
+                        self._request_queue_fetch()
+                except AlreadyFetchingException:
+                        return
+                self.run_fetch_queue()
         
-        def upload_track(self, artist, title, size, f):
+        def upload_track(self, artist, title, size, f, progressCb=None):
                 """ Uploads a track in <f> with <size> to marietje as
                     <artist> - <title> """
-                self.raw.upload_track(artist, title, self.username, size, f)
+                self.raw.upload_track(artist, title, self.username, size, f,
+                                      progressCb)
 
 if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,264 @@
+""" Binary, memory mapped cache of the songs and their live search look-up
+    structure.
+
+    The file starts with a header (see HEADER), followed by, in order:
+        ids             sorted track ids                    nsongs * int32
+        song offsets    artist and title of each id in the
+                        song heap                       (2*nsongs+1) * uint32
+        entry objs      track id of each search entry     nentries * int32
+        entry offsets   text of each entry in the text
+                        heap                             (nentries+1) * uint32
+        song heap       the artists and titles
+        text heap       the search texts, each followed by SA_SEPARATOR
+    All integers are little endian. """
+
+import sys
+import mmap
+import struct
+import operator
+from array import array
+from bisect import bisect_left
+from lstree import MappedLSTree, SA_SEPARATOR, pack_arrays, unpack_arrays
+
+MAGIC = 'PMSC'
+VERSION = 1
+# magic, version, nsongs, nentries, song heap size, text heap size
+HEADER = struct.Struct('<4sIIIII')
+# Number of songs diff compares at once
+DIFF_BLOCK = 256
+
+class CacheError(Exception):
+        pass
+
+class Catalog(object):
+        """ Read-only mapping of track ids to (artist, title), stored in
+            columns: a sorted array of the ids and an array with the
+            offsets of their artists and titles in the song heap, which
+            starts at <heap> in the string or buffer <buf>.  The songs in
+            a cache are served from the mapping this way, and fetched
+            songs are stored this way for they take several times less
+            memory than a dict of tuples. """
+        def __init__(self, buf, ids, offsets, heap=0):
+                self.buf = buf
+                self.ids = ids
+                self.offsets = offsets
+                self.heap = heap
+
+        def _index(self, id):
+                i = bisect_left(self.ids, id)
+                if i == len(self.ids) or self.ids[i] != id:
+                        return None
+                return i
+
+        def _value(self, i):
+                start, middle, end = (self.offsets[2*i],
+                                      self.offsets[2*i+1],
+                                      self.offsets[2*i+2])
+                return (self.buf[self.heap + start:self.heap + middle],
+                        self.buf[self.heap + middle:self.heap + end])
+
+        def __getitem__(self, id):
+                i = self._index(id)
+                if i is None:
+                        raise KeyError, id
+                return self._value(i)
+
+        def __contains__(self, id):
+                return self._index(id) is not None
+
+        def __len__(self):
+                return len(self.ids)
+
+        def __iter__(self):
+                return self.iterkeys()
+
+        def get(self, id, default=None):
+                i = self._index(id)
+                return default if i is None else self._value(i)
+
+        def iterkeys(self):
+                for i in xrange(len(self.ids)):
+                        yield self.ids[i]
+
+        def itervalues(self):
+                for i in xrange(len(self.ids)):
+                        yield self._value(i)
+
+        def iteritems(self):
+                for i in xrange(len(self.ids)):
+                        yield (self.ids[i], self._value(i))
+
+        def keys(self):
+                return list(self.iterkeys())
+
+        def values(self):
+                return list(self.itervalues())
+
+        def items(self):
+                return list(self.iteritems())
+
+        def lengths(self):
+                """ Returns the lengths of the artists and of the titles,
+                    in the order of the ids """
+                offsets = self.offsets
+                lengths = [offsets[i + 1] - offsets[i]
+                                for i in xrange(len(offsets) - 1)]
+                return lengths[0::2], lengths[1::2]
+
+        def __getstate__(self):
+                return (self.buf[self.heap:self.heap + self.offsets[-1]],
+                        pack_arrays({'ids': self.ids,
+                                     'offsets': self.offsets}))
+
+        def __setstate__(self, state):
+                heap, arrays = state
+                arrays = unpack_arrays(arrays)
+                self.__init__(heap, arrays['ids'], arrays['offsets'])
+
+def _columns(songs):
+        """ Returns the sorted ids, the offsets and the song heap of
+            <songs> """
+        if isinstance(songs, Catalog):
+                return (songs.ids, songs.offsets,
+                        songs.buf[songs.heap:songs.heap + songs.offsets[-1]])
+        ids = array('i', sorted(songs))
+        offsets = array('I', [0])
+        heap = list()
+        size = 0
+        for id in ids:
+                for txt in songs[id]:
+                        heap.append(txt)
+                        size += len(txt)
+                        offsets.append(size)
+        return ids, offsets, ''.join(heap)
+
+def catalog(songs):
+        """ Returns a Catalog with the (artist, title) of each id in the
+            mapping <songs> """
+        ids, offsets, heap = _columns(songs)
+        return Catalog(heap, ids, offsets)
+
+def _same_block(ids1, offsets1, heap1, i, ids2, offsets2, heap2, j, k):
+        """ Returns whether the <k> songs from index <i> of the first
+            columns are the same as those from index <j> of the second """
+        if buffer(ids1, 4 * i, 4 * k) != buffer(ids2, 4 * j, 4 * k):
+                return False
+        start1, end1 = offsets1[2*i], offsets1[2*i+2*k]
+        start2, end2 = offsets2[2*j], offsets2[2*j+2*k]
+        if buffer(heap1, start1, end1 - start1) != \
+                        buffer(heap2, start2, end2 - start2):
+                return False
+        # The artists and titles must be split at the same places
+        if start1 == start2:
+                return buffer(offsets1, 8 * i, 4 * (2*k+1)) == \
+                                buffer(offsets2, 8 * j, 4 * (2*k+1))
+        return map(operator.sub, offsets1[2*i:2*i+2*k+1],
+                   [start1] * (2*k+1)) == \
+               map(operator.sub, offsets2[2*j:2*j+2*k+1],
+                   [start2] * (2*k+1))
+
+def diff(old, new):
+        """ Returns the ids of the songs in the mapping <old> that aren't
+            in the mapping <new> or differ in it, and those of the songs in
+            <new> that aren't in <old> or differ in it.  The columns are
+            compared as they are: the ids are merged, and the songs with
+            the same ids are compared DIFF_BLOCK at a time on their slice
+            of the heap and their offsets in it. """
+        ids1, offsets1, heap1 = _columns(old)
+        ids2, offsets2, heap2 = _columns(new)
+        if buffer(ids1) == buffer(ids2) and heap1 == heap2 and \
+                        buffer(offsets1) == buffer(offsets2):
+                return [], []
+        removed = list()
+        added = list()
+        i = j = 0
+        while i < len(ids1) and j < len(ids2):
+                k = min(DIFF_BLOCK, len(ids1) - i, len(ids2) - j)
+                if _same_block(ids1, offsets1, heap1, i,
+                               ids2, offsets2, heap2, j, k):
+                        i += k
+                        j += k
+                        continue
+                # Merge the block song by song
+                for n in xrange(k):
+                        if i == len(ids1) or j == len(ids2):
+                                break
+                        if ids1[i] < ids2[j]:
+                                removed.append(ids1[i])
+                                i += 1
+                        elif ids1[i] > ids2[j]:
+                                added.append(ids2[j])
+                                j += 1
+                        else:
+                                if not _same_block(ids1, offsets1, heap1, i,
+                                                ids2, offsets2, heap2, j, 1):
+                                        removed.append(ids1[i])
+                                        added.append(ids2[j])
+                                i += 1
+                                j += 1
+        removed.extend(ids1[i:])
+        added.extend(ids2[j:])
+        return removed, added
+
+def _array(buf, offset, length, typecode='i'):
+        """ Reads an array of <length> 32 bit integers at <offset> """
+        a = array(typecode)
+        a.fromstring(buf[offset:offset + 4 * length])
+        if sys.byteorder != 'little':
+                a.byteswap()
+        return a
+
+def _tostring(a):
+        if sys.byteorder != 'little':
+                a = array(a.typecode, a)
+                a.byteswap()
+        return a.tostring()
+
+def write(f, songs, sLut):
+        """ Writes <songs> and the entries of <sLut> to the file <f> """
+        ids, song_offsets, song_heap = _columns(songs)
+        entry_objs = array('i')
+        entry_offsets = array('I', [0])
+        text_heap = list()
+        size = 0
+        for txt, obj in sLut.entries():
+                entry_objs.append(obj)
+                text_heap.append(txt + SA_SEPARATOR)
+                size += len(txt) + 1
+                entry_offsets.append(size)
+        text_heap = ''.join(text_heap)
+        f.write(HEADER.pack(MAGIC, VERSION, len(ids), len(entry_objs),
+                            len(song_heap), len(text_heap)))
+        for a in (ids, song_offsets, entry_objs, entry_offsets):
+                f.write(_tostring(a))
+        f.write(song_heap)
+        f.write(text_heap)
+
+def read(f):
+        """ Maps the cache in the file <f>.  Returns (songs, sLut).  Only
+            the offset tables are read into memory: the strings are
+            served lazily from the mapping. """
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buf) < HEADER.size:
+                raise CacheError, "Truncated cache"
+        magic, version, nsongs, nentries, song_heap_size, text_heap_size = \
+                        HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+                raise CacheError, "Not a songs cache"
+        if version != VERSION:
+                raise CacheError, "Unsupported cache version %s" % version
+        offset = HEADER.size
+        ids = _array(buf, offset, nsongs)
+        offset += 4 * nsongs
+        song_offsets = _array(buf, offset, 2 * nsongs + 1, 'I')
+        offset += 4 * (2 * nsongs + 1)
+        entry_objs = _array(buf, offset, nentries)
+        offset += 4 * nentries
+        entry_offsets = _array(buf, offset, nentries + 1, 'I')
+        offset += 4 * (nentries + 1)
+        song_heap = offset
+        text_heap = song_heap + song_heap_size
+        if text_heap + text_heap_size != len(buf):
+                raise CacheError, "Truncated cache"
+        return (Catalog(buf, ids, song_offsets, song_heap),
+                MappedLSTree(buf, text_heap, entry_offsets, entry_objs))
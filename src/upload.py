@@ -1,11 +1,339 @@
 import os
 import sys
 import time
-from marietje import RawMarietje
+import Queue
+import hashlib
+import unicodedata
+import cPickle
+import threading
+import multiprocessing
+from marietje import RawMarietje, Marietje
 from optparse import OptionParser
 
+DEFAULT_JOBS = 4
+DEFAULT_USERDIR = '.pymarietje'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def read_tags(fn):
+        """ Returns (fn, artist, title, size) for the file <fn> using
+            mutagen, or (fn, None, None, error) if it can't. """
+        import mutagen
+        try:
+                tags = mutagen.File(fn, easy=True)
+        except Exception, e:
+                return (fn, None, None, str(e))
+        if tags is None:
+                return (fn, None, None, "not a known audio file")
+        if not 'artist' in tags or not 'title' in tags:
+                return (fn, None, None, "no artist or title tag")
+        return (fn, tags['artist'][0], tags['title'][0],
+                        os.stat(fn).st_size)
+
+def hash_file(fn):
+        """ Returns the sha1 hex digest of the contents of <fn> """
+        h = hashlib.sha1()
+        with open(fn, 'rb') as f:
+                while True:
+                        data = f.read(HASH_CHUNK_SIZE)
+                        if len(data) == 0:
+                                break
+                        h.update(data)
+        return h.hexdigest()
+
+def _normalize(txt):
+        """ Returns the words of letters and digits of <txt> in lower case
+            and without accents.  A str is assumed to be UTF-8, or
+            Latin-1 if it isn't. """
+        if not isinstance(txt, unicode):
+                try:
+                        txt = txt.decode('utf-8')
+                except UnicodeDecodeError:
+                        txt = txt.decode('latin-1')
+        txt = unicodedata.normalize('NFKD', txt.lower())
+        return u' '.join(u''.join([c if c.isalnum() else u' ' for c in txt
+                        if not unicodedata.combining(c)]).split())
+
+def track_key(artist, title):
+        """ Returns the key of <artist> - <title> that ignores case,
+            accents, punctuation and whitespace, as UTF-8, or None if the
+            artist or title has no letters or digits to tell it by """
+        artist = _normalize(artist)
+        title = _normalize(title)
+        if not artist or not title:
+                return None
+        return (u"%s - %s" % (artist, title)).encode('utf-8')
+
+class UploadIndex:
+        """ Local index of the tracks uploaded before and of those on
+            marietje, to skip duplicates before uploading.  The content
+            hashes and keys of the uploaded tracks are stored in the file
+            <path>, together with the hashes of the files seen, such that
+            files are only hashed again when they change. """
+        def __init__(self, path):
+                self.path = path
+                # path -> (size, mtime, digest)
+                self.files = dict()
+                # digest -> key
+                self.digests = dict()
+                self.keys = set()
+                self.catalog = set()
+                if not os.path.exists(path):
+                        return
+                try:
+                        with open(path, 'rb') as f:
+                                self.files, self.digests = cPickle.load(f)
+                except Exception, e:
+                        print "warning: ignoring index %s: %s" % (path, e)
+                self.keys = set([key for key in self.digests.itervalues()
+                                if not key is None])
+
+        def load_catalog(self, m, f):
+                """ Adds the songs on marietje from the songs cache in <f>,
+                    read by the Marietje <m> """
+                m.songs_from_cache(f, rebuild=False)
+                self.catalog.update([track_key(artist, title) for
+                                artist, title in m.songs.itervalues()])
+                self.catalog.discard(None)
+
+        def cached_digest(self, fn):
+                """ Returns the digest of <fn> if it didn't change since it
+                    was last hashed, otherwise None """
+                st = os.stat(fn)
+                entry = self.files.get(os.path.abspath(fn))
+                if entry is None or entry[:2] != (st.st_size, st.st_mtime):
+                        return None
+                return entry[2]
+
+        def set_digest(self, fn, digest):
+                st = os.stat(fn)
+                self.files[os.path.abspath(fn)] = (st.st_size, st.st_mtime,
+                                                   digest)
+
+        def find(self, digest, key):
+                """ Returns why the track with <digest> and <key> is a
+                    duplicate, or None if it isn't """
+                if digest in self.digests:
+                        if self.digests[digest] is None:
+                                return "uploaded before"
+                        return "uploaded before as %s" % self.digests[digest]
+                if key is None:
+                        # Nothing to compare the names by
+                        return None
+                if key in self.catalog:
+                        return "on marietje"
+                if key in self.keys:
+                        return "uploaded before"
+                return None
+
+        def add(self, digest, key):
+                """ Records the upload of the track with <digest> as <key> """
+                self.digests[digest] = key
+                if not key is None:
+                        self.keys.add(key)
+
+        def save(self):
+                with open(self.path + '.new', 'wb') as f:
+                        cPickle.dump((self.files, self.digests), f,
+                                     cPickle.HIGHEST_PROTOCOL)
+                os.rename(self.path + '.new', self.path)
+
+def open_index(options):
+        """ Returns the UploadIndex in the userdir, with the songs on
+            marietje from its songs cache, or None if there is no
+            userdir """
+        userdir = os.path.expanduser(os.path.join('~', options.userdir))
+        if not os.path.isdir(userdir):
+                return None
+        index = UploadIndex(os.path.join(userdir, 'upload-index'))
+        fp = os.path.join(userdir, 'songs-cache')
+        if os.path.exists(fp):
+                m = Marietje(options.username, host=options.host,
+                                port=options.port)
+                try:
+                        with open(fp, 'rb') as f:
+                                index.load_catalog(m, f)
+                except Exception, e:
+                        print "warning: ignoring songs cache %s: %s" % (fp, e)
+        return index
+
+def find_duplicates(index, tracks, map=map):
+        """ Splits the <tracks>, (fn, artist, title, size) tuples, into
+            those to upload and those that are known to the <index>.
+            Returns (todo, skipped, digests) where skipped is a list of
+            (fn, reason) and digests maps file names to their hashes.
+            The files that are not hashed yet are hashed using <map>. """
+        fns = [fn for fn, artist, title, size in tracks]
+        digests = dict()
+        for fn in fns:
+                digest = index.cached_digest(fn)
+                if not digest is None:
+                        digests[fn] = digest
+        missing = [fn for fn in fns if not fn in digests]
+        for fn, digest in zip(missing, map(hash_file, missing)):
+                digests[fn] = digest
+                index.set_digest(fn, digest)
+        todo = list()
+        skipped = list()
+        seen = dict()
+        for track in tracks:
+                fn, artist, title, size = track
+                digest = digests[fn]
+                reason = index.find(digest, track_key(artist, title))
+                if reason is None and digest in seen:
+                        reason = "same as %s" % seen[digest]
+                if reason is None:
+                        seen[digest] = fn
+                        todo.append(track)
+                else:
+                        skipped.append((fn, reason))
+        return todo, skipped, digests
+
+def record_uploads(index, results, tracks, digests):
+        """ Adds the uploaded <tracks> to the <index> and saves it """
+        keys = dict([(fn, track_key(artist, title))
+                        for fn, artist, title, size in tracks])
+        for fn, size, d, error in results:
+                if error is None:
+                        index.add(digests[fn], keys[fn])
+        try:
+                index.save()
+        except EnvironmentError, e:
+                print "warning: failed to save %s: %s" % (index.path, e)
+
+def find_files(paths):
+        """ Returns the files in <paths>, recursing into directories """
+        ret = list()
+        for path in paths:
+                if not os.path.isdir(path):
+                        ret.append(path)
+                        continue
+                for dirpath, dirnames, filenames in os.walk(path):
+                        dirnames.sort()
+                        for fn in sorted(filenames):
+                                ret.append(os.path.join(dirpath, fn))
+        return ret
+
+def check_username(options):
+        if options.username is None:
+                options.username = os.getlogin()
+        else:
+                if options.username != os.getlogin() and not options.quiet:
+                        print "warning: %s (input) != %s (system)" % (
+                                        options.username, os.getlogin())
+
+def upload_batch(options, tracks):
+        """ Uploads the <tracks>, (fn, artist, title, size) tuples, over at
+            most options.jobs connections.  Returns a list of
+            (fn, size, duration, error) """
+        m = RawMarietje(options.host, options.port)
+        todo = Queue.Queue()
+        for i, track in enumerate(tracks):
+                todo.put((i, track))
+        results = [None] * len(tracks)
+        lock = threading.Lock()
+        def worker():
+                while True:
+                        try:
+                                i, (fn, artist, title, size) = \
+                                                todo.get_nowait()
+                        except Queue.Empty:
+                                return
+                        start_time = time.time()
+                        error = None
+                        try:
+                                with open(fn, 'rb') as f:
+                                        m.upload_track(artist, title,
+                                                options.username, size, f)
+                        except Exception, e:
+                                # Any failure is that of this file only
+                                error = str(e) or e.__class__.__name__
+                        dur = time.time() - start_time
+                        with lock:
+                                results[i] = (fn, size, dur, error)
+                                if not options.quiet:
+                                        print "%s %s" % ("failed" if error
+                                                else "uploaded", fn)
+        threads = [threading.Thread(target=worker)
+                        for i in xrange(min(options.jobs, len(tracks)))]
+        for t in threads:
+                t.start()
+        for t in threads:
+                t.join()
+        return results
+
+def print_summary(results, dur):
+        """ Prints a table of the <results> of upload_batch, which took
+            <dur> seconds """
+        w = max([len(fn) for fn, size, d, error in results] + [4])
+        print "%-*s %10s %8s %8s" % (w, "file", "MB", "s", "MB/s")
+        total = 0
+        for fn, size, d, error in results:
+                if error is None:
+                        total += size
+                        print "%-*s %10.1f %8.1f %8.2f" % (w, fn,
+                                size / 1024.0 / 1024, d,
+                                size / max(d, 0.001) / 1024 / 1024)
+                else:
+                        print "%-*s %s" % (w, fn, error)
+        print "%-*s %10.1f %8.1f %8.2f" % (w, "total",
+                        total / 1024.0 / 1024, dur,
+                        total / max(dur, 0.001) / 1024 / 1024)
+
+def batch_main(options, args):
+        if not options.artist is None or not options.title is None:
+                print "error: --artist and --title need a single file"
+                sys.exit(-1)
+        if not options.mutagen:
+                print "error: several files need mutagen for their tags"
+                sys.exit(-1)
+        check_username(options)
+        files = find_files(args)
+        index = None if options.duplicates else open_index(options)
+        pool = multiprocessing.Pool()
+        try:
+                tags = pool.map(read_tags, files)
+                tracks = list()
+                for fn, artist, title, size in tags:
+                        if artist is None:
+                                if not options.quiet:
+                                        print "skipping %s: %s" % (fn, size)
+                                continue
+                        tracks.append((fn, artist, title, size))
+                if not index is None:
+                        tracks, skipped, digests = find_duplicates(index,
+                                        tracks, pool.map)
+                        if not options.quiet or options.dry_run:
+                                for fn, reason in skipped:
+                                        print "skipping %s: %s" % (fn, reason)
+        finally:
+                pool.close()
+        if options.dry_run:
+                for fn, artist, title, size in tracks:
+                        print "would upload %s as %s - %s" % (fn, artist, title)
+                if not index is None:
+                        index.save()
+                return
+        if len(tracks) == 0:
+                print "error: nothing to upload"
+                sys.exit(-2)
+        if not options.force:
+                print "Will upload as %s" % options.username
+                for fn, artist, title, size in tracks:
+                        print " %s\n   as %s - %s" % (fn, artist, title)
+                print "Are you sure? (press enter)",
+                c = sys.stdin.read(1)
+        start_time = time.time()
+        results = upload_batch(options, tracks)
+        dur = time.time() - start_time
+        if not options.quiet:
+                print_summary(results, dur)
+        if not index is None:
+                record_uploads(index, results, tracks, digests)
+        if [r for r in results if not r[3] is None]:
+                sys.exit(-3)
+
 def main():
-        usage = "usage: %prog [options] file-name"
+        usage = "usage: %prog [options] file-name|directory ..."
         parser = OptionParser(usage=usage)
 
         parser.add_option("-a", "--artist", dest="artist", default=None,
@@ -25,6 +353,18 @@ def main():
                         help="Be quiet, implies force")
         parser.add_option("--no-mutagen", dest="mutagen", action="store_false",
                         help="Don't use mutagen to extract tags", default=True)
+        parser.add_option("-j", "--jobs", dest="jobs", default=DEFAULT_JOBS,
+                        type=int, metavar="N",
+                        help="Upload several files over N connections")
+        parser.add_option("-n", "--dry-run", dest="dry_run",
+                        action="store_true",
+                        help="Only list what would be uploaded and skipped")
+        parser.add_option("--duplicates", dest="duplicates",
+                        action="store_true",
+                        help="Don't skip tracks that are already on marietje")
+        parser.add_option("--userdir", dest="userdir",
+                        default=DEFAULT_USERDIR, metavar="PATH",
+                        help="Use the index and songs cache in PATH")
 
         (options, args) = parser.parse_args()
 
@@ -34,6 +374,10 @@ def main():
         
         if options.quiet:
                 options.force = True
+
+        if len(args) > 1 or os.path.isdir(args[0]):
+                batch_main(options, args)
+                return
         
         fn = args[0]
         if options.mutagen:
@@ -65,12 +409,25 @@ def main():
                         print "warning: %s (input) != %s (tag)" % (
                                         options.title, tags['title'][0])
         
-        if options.username is None:
-                options.username = os.getlogin()
-        else:
-                if options.username != os.getlogin() and not options.quiet:
-                        print "warning: %s (input) != %s (system)" % (
-                                        options.username, os.getlogin())
+        check_username(options)
+
+        index = None if options.duplicates else open_index(options)
+        if not index is None:
+                track = (fn, options.artist, options.title,
+                                os.stat(fn).st_size)
+                todo, skipped, digests = find_duplicates(index, [track])
+                for skipped_fn, reason in skipped:
+                        print "skipping %s: %s" % (skipped_fn, reason)
+                if options.dry_run or not todo:
+                        index.save()
+        if options.dry_run:
+                if index is None or todo:
+                        print "would upload %s as %s - %s" % (fn,
+                                        options.artist, options.title)
+                return
+        if not index is None and not todo:
+                # Skipping a duplicate is no error
+                return
         
         if not options.force:
                 print ("Will upload as %s\n"+
@@ -84,15 +441,22 @@ def main():
 
         m = RawMarietje(options.host, options.port)
         size = os.stat(fn).st_size
-        f = open(fn)
+        f = open(fn, 'rb')
         start_time = time.time()
+        def progress(sent, size):
+                sys.stdout.write("\r%3d%%" % (100 * sent / size))
+                sys.stdout.flush()
         m.upload_track(options.artist, options.title,
-                        options.username, size, f)
+                        options.username, size, f,
+                        progressCb=None if options.quiet else progress)
         dur = time.time() - start_time
         f.close()
         if not options.quiet:
-                print "Finished in %ss: %sMB/s" % (
+                print "\rFinished in %ss: %sMB/s" % (
                                 dur, size / dur / 1024 / 1024)
+        if not index is None:
+                record_uploads(index, [(fn, size, dur, None)], [track],
+                               digests)
 
 if __name__ == '__main__':
         main()